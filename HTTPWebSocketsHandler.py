@@ -13,12 +13,14 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 
 import sys
 import codecs
-import struct
 import errno, socket #for socket exceptions
 import threading
 import traceback
+import queue
 from base64 import b64encode
 from hashlib import sha1
+import wsframe
+from wsframe import WebSocketError
 
 VER = sys.version_info[0]
 if VER >= 3:
@@ -30,9 +32,6 @@ else:
     from mimetools import Message
     from SimpleHTTPServer import SimpleHTTPRequestHandler
 
-class WebSocketError(Exception):
-    pass
-
 class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
     _ws_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
     _opcode_continu = 0x0
@@ -43,6 +42,9 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
     _opcode_pong = 0xa
 
     mutex = threading.Lock()
+    max_message_size = wsframe.DEFAULT_MAX_MESSAGE_SIZE
+    send_queue_size = 256  # frames waiting for a slow client, more close the connection
+    writer_stop_timeout = 2.0  # secs to wait for the writer to flush the last frames at close
 
     def on_ws_message(self, message):
         """Override this handler to process incoming websocket messages."""
@@ -100,6 +102,7 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
             #This handler is in websocket mode now.
             #do_GET only returns after client close or socket error.
             self._read_messages()
+            self._stop_writer()
         else:
             SimpleHTTPRequestHandler.do_GET(self)
 
@@ -117,98 +120,72 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
                 self.log_error("RCV: Exception: in _read_messages: %s" % str(err.args))
                 self._ws_close()
 
-    def _read_bytes(self, length):
-        # print(" read_bytes(%d)"%(length))
-        raw_data = self.rfile.read(length)
-        return raw_data
-
     def _read_next_message(self):
         #self.rfile.read(n) is blocking.
         #it returns however immediately when the socket is closed.
-        try:
-            byte = self._read_bytes(1)
-            self.opcode = ord(byte) & 0x0F
-            # print("op : ", self.opcode)
-            length = ord(self._read_bytes(1)) & 0x7F
-            # print("length : ", length)
-            if length == 126:
-                length = struct.unpack(">H", self._read_bytes(2))[0]
-            elif length == 127:
-                length = struct.unpack(">Q", self._read_bytes(8))[0]
-            masks = self._read_bytes(4)
-            # print("MASKS : {}".format(masks))
-            decoded = None
-            if VER >= 3:
-                decoded = bytearray()
-            else:
-                decoded = ''
-            datastream = self._read_bytes(length)
-            # print("datastream : {}".format(datastream))
-            for char in datastream:
-                if VER >= 3:
-                    decoded.append(char ^ masks[len(decoded) % 4])
-                else:
-                    decoded += chr(ord(char) ^ ord(masks[len(decoded) % 4]))
-
-            if VER >= 3:
-                decoded = bytes(decoded)
-                # print("length of decdoecd = {}".format(len(decoded)))
-                # print("length of decdoecd.decode() = {}".format(len(decoded.decode())))
-            self._on_message(decoded)
-        except (struct.error, TypeError) as e:
-            traceback.print_exc()
-            #catch exceptions from ord() and struct.unpack()
+        message = self.frame_reader.read_message()
+        if message is None:
             if self.connected:
                 raise WebSocketError("Websocket read aborted while listening")
             else:
                 #the socket was closed while waiting for input
                 self.log_error("RCV: _read_next_message aborted after closed connection")
-                pass
-
-    def _send_impl(self, msg):
-        # print("_send_impl .... {}".format(type(msg)))
-        global VER
-        if VER >= 3:
-            data = bytearray()
-            if type(msg) == int:
-                data = bytes([msg])
-            elif type(msg) == bytes:
-                data = msg
-            elif type(msg) == str:
-                data = msg.encode()
-            self.request.send(data)
-        else:
-            data = msg
-            if type(msg) == int:
-                data = chr(msg)
-            self.request.send(data)
+            return
+        self.opcode, decoded = message
+        self._on_message(decoded)
 
     def _send_message(self, opcode, message):
+        self.send_frame(wsframe.encode_frame(opcode, message))
+
+    def send_frame(self, frame):
+        #the frames are only queued here and sent by the writer thread of the connection,
+        #so frames of different threads can't interleave and a slow client doesn't block the caller
+        send_queue = getattr(self, 'send_queue', None)
+        if send_queue is None or self.aborted:
+            return
         try:
-            #use of self.wfile.write gives socket exception after socket is closed. Avoid.
-            self._send_impl(0x80 + opcode)
-            length = len(message)
-            if length <= 125:
-                self._send_impl(length)
-            elif length >= 126 and length <= 65535:
-                self._send_impl(126)
-                self._send_impl(struct.pack(">H", length))
-            else:
-                self._send_impl(127)
-                self._send_impl(struct.pack(">Q", length))
-            if length > 0:
-                # print("_send_message : lenght = {}".format(length))
-                self._send_impl(message)
-        except socket.error as e:
-            #websocket content error, time-out or disconnect.
-            traceback.print_exc()
-            self.log_message("SND: Close connection: Socket Error %s" % str(e.args))
-            self._ws_close()
-        except Exception as err:
-            #unexpected error in websocket connection.
-            traceback.print_exc()
-            self.log_error("SND: Exception: in _send_message: %s" % str(err.args))
-            self._ws_close()
+            send_queue.put_nowait(frame)
+        except queue.Full:
+            #can't call _ws_close() here, as it might be the caller already
+            self.log_message("SND: Close connection: send queue full")
+            self._abort_connection()
+
+    def _write_frames(self, send_queue):
+        while True:
+            frame = send_queue.get()
+            if frame is None:
+                return
+            try:
+                #use of self.wfile.write gives socket exception after socket is closed. Avoid.
+                self.request.sendall(frame)
+            except socket.error as e:
+                #websocket content error, time-out or disconnect.
+                self.log_message("SND: Close connection: Socket Error %s" % str(e.args))
+                self._abort_connection()
+                return
+
+    def _start_writer(self):
+        self.send_queue = queue.Queue(self.send_queue_size)
+        self.aborted = False
+        self.writer = threading.Thread(target=self._write_frames, args=(self.send_queue,),
+                                       name='ws-writer', daemon=True)
+        self.writer.start()
+
+    def _stop_writer(self):
+        #lets the writer send the frames queued so far, the close frame included
+        try:
+            self.send_queue.put_nowait(None)
+        except queue.Full:
+            self._abort_connection()
+        self.writer.join(self.writer_stop_timeout)
+
+    def _abort_connection(self):
+        #wakes up the blocking read, so the reader thread closes the connection
+        self.aborted = True
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
 
     def _handshake(self):
         headers=self.headers
@@ -224,6 +201,8 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
         self.send_header('Connection', 'Upgrade')
         self.send_header('Sec-WebSocket-Accept', digest)
         self.end_headers()
+        self.frame_reader = wsframe.FrameReader(self.rfile, self.max_message_size)
+        self._start_writer()
         self.connected = True
         #self.close_connection = 0
         self.on_ws_connected()
@@ -275,8 +254,4 @@ class HTTPWebSocketsHandler(SimpleHTTPRequestHandler):
 
     def _send_close(self):
         #Dedicated _send_close allows for catch all exception handling
-        msg = bytearray()
-        msg.append(0x80 + self._opcode_close)
-        msg.append(0x00)
-        # print(" >> _send_close")
-        self._send_impl(msg)
+        self._send_message(self._opcode_close, b'')
@@ -3,15 +3,36 @@
 
 import string
 import secrets
+import csv
+import io
+import json
 import datetime
 import queue
-from threading import Thread, Lock
+import heapq
+import asyncio
+import functools
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, namedtuple
+from threading import Lock, BoundedSemaphore
 import defaults
 import idcard
+from chunkeddict import ChunkedDict
 import zuullogger
+from timetable import TimeTable
+from tokenstore import TokenStore
+from user import User
 
 logger = zuullogger.getLogger(__name__)
 
+# to be increased when the calculation of the user table changes, so stored tables get recalculated
+STAMP_VERSION = 1
+
+# read only view of the user data, as published after each change
+UserSnapshot = namedtuple(
+	'UserSnapshot', ['version', 'users', 'timetables', 'sponsor_index', 'stamp'])
+
 
 class AccessManager:
 	'''contains all the function around user add & deletes, permissions etc.
@@ -28,12 +49,57 @@ class AccessManager:
 		self.modref = modref
 		self.mutex = Lock()  # prepare lock for atomar data changes
 		self.users = self.modref.store.get_users()
-		self.queue = queue.Queue()  # queue to receive ansers from websocket
+		# request_id -> queue to receive the anser from websocket for each waiting requestOTP call
+		self.otp_requests = OrderedDict()
+		self.otp_requests_mutex = Lock()
+		# worker threads for the *_async() functions to keep disk and cpu load out of event loops
+		self.executor = ThreadPoolExecutor(
+			max_workers=defaults.ACCESS_MANAGER_WORKERS, thread_name_prefix='accessmanager')
+		# an own small pool for the cpu bound id card signing, so a burst of id card requests
+		# neither blocks the event loop nor the other *_async() functions
+		self.id_card_executor = None
+		if defaults.ID_CARD_WORKERS:
+			self.id_card_executor = ThreadPoolExecutor(
+				max_workers=defaults.ID_CARD_WORKERS, thread_name_prefix='idcard')
+		self.id_card_jobs = BoundedSemaphore(defaults.ID_CARD_QUEUE_SIZE)
 		self.restart_function = restart_function
 		self.smart_home_interface = modref.server
-		# initial build of internal data tables
-		self.garbage_collection(self.users['users'].copy())
-		self.current_tokens = {}  # list of actual valid OTP token
+		# reverse index follower_id -> {sponsor_id: set of time_table_ids} of all active key lendings
+		self.sponsor_index = {}
+		# the readers only use the last published snapshot, see publish_snapshot()
+		self.snapshot = None
+		# the entries changed since then, to be copied into the next snapshot
+		self.unpublished_users = set(self.users['users'])
+		self.unpublished_sponsors = set()
+		self.unpublished_followers = set()
+		# (sponsor_id, time_table_id, follower_id) -> deletion timestamp of the changed key lendings, for the journal
+		self.unpublished_edges = {}
+		# the content of the next snapshot, see publish_snapshot()
+		self.snapshot_users = ChunkedDict()
+		self.snapshot_timetables = ChunkedDict()
+		self.snapshot_sponsors = ChunkedDict()
+		# XOR of edge_hash() of all active key lendings, kept up to date together with the sponsor index
+		self.edge_checksum = 0
+		# config_stamp() of the config the actual user table has been calculated with
+		self.user_table_config_stamp = None
+		self.startup_times = []  # list of (step, secs) for the startup report
+		start = time.perf_counter()
+		self.build_sponsor_index()
+		self.startup_times.append(('sponsor index', time.perf_counter() - start))
+		start = time.perf_counter()
+		config_stamp = self.config_stamp()
+		if self.users.get('stamp') == self.user_table_stamp(config_stamp):
+			# nothing has changed since the user table was stored, so it's still valid
+			self.user_table_config_stamp = config_stamp
+			self.publish_snapshot()
+			self.startup_times.append(('stored user table', time.perf_counter() - start))
+		else:
+			# initial build of internal data tables
+			self.garbage_collection(self.users['users'].copy())
+			self.startup_times.append(('user table calculation', time.perf_counter() - start))
+		self.current_tokens = TokenStore()  # the actual valid OTP token
+		# service tokens with an already verified signature, until they get too old
+		self.verified_service_tokens = TokenStore(defaults.MAX_VERIFIED_SERVICE_TOKENS)
 
 	def msg(self, data, ws_user):
 		''' handles incoming websocket messages
@@ -47,7 +113,7 @@ class AccessManager:
 
 		if data['type'] == 'ac_otprequest':
 			# answer received from websocket (in websocket context), put in queue for further processing
-			self.queue.put(data)
+			self.answer_otp_request(data)
 		if data['type'] == 'ac_newconfig':
 			# new config data received from Web UI
 			self.write_config(data['config'])
@@ -55,6 +121,9 @@ class AccessManager:
 		if data['type'] == 'ac_tokenquery':
 			ws_user.ws.emit(
 				"tokenstate", {'valid': self.validate_token(data['config']['token']), 'msg':data['config']})
+		# list of keys to lend and return in one go
+		if data['type'] == 'ac_bulk':
+			ws_user.ws.emit("bulkresult", self.bulk_import(data['config']))
 
 	def write_config(self, data):
 		''' stores changed config data on disk
@@ -73,13 +142,117 @@ class AccessManager:
 			if current_password and key=='messenger_token':
 				continue
 			if key in data:
-				logger.debug("new config {0} {1}".format(key, repr(data[key])))
-				self.modref.store.write_config_value(key, data[key], True)
-		self.modref.store.create_new_admins_if_any()
+				value = data[key]
+				if key == 'timetolive':
+					# the time tables can only hold TTLs up to TimeTable.MAX_TTL
+					value = self.modref.store.valid_time_to_live(value)
+					if value is None:
+						logger.warning("invalid timetolive {0} ignored".format(repr(data[key])))
+						continue
+				logger.debug("new config {0} {1}".format(key, repr(value)))
+				self.modref.store.write_config_value(key, value, True)
 		self.modref.store.save_config()
+		if self.apply_config():
+			# the web UI would not get the changes of a whole recalculation as deltas
+			self.modref.store.resend_tree()
 		if self.restart_function:  # restart bot
 			self.restart_function()
 
+	def apply_config(self):
+		''' recalculates the user table, if the config values it depends on (admins, timetolive) have been changed
+
+		The new table is published and written to disk as a whole by garbage_collection()
+
+		Return:
+		True, if the user table has been recalculated
+		'''
+
+		if self.config_stamp() == self.user_table_config_stamp:
+			return False
+		self.garbage_collection(self.snapshot.users)
+		return True
+
+	def bulk_import(self, data):
+		''' lends and returns a list of keys received as CSV or NDJSON text
+
+		CSV needs a header line, both formats use the fields
+		action ('grant' or 'revoke'), sponsor_id, user_id, first_name, last_name, language
+
+		Args:
+		data (:obj:`obj`): data object
+				current_password (:obj:`str`): the config password
+				format (:obj:`str`): 'csv' or 'ndjson'
+				data (:obj:`str`): the changes
+
+		Return:
+		object containing the number of applied changes, the ids of the users which got or lost access and a list of errors
+		'''
+
+		current_password = self.modref.store.read_config_value('current_password')
+		if not current_password == data.get('current_password'):
+			logger.debug("wrong password {0}".format(data.get('current_password')))
+			return {'changes': 0, 'changed_users': [], 'errors': ['wrong password']}
+		changes, errors = self.read_bulk_changes(data.get('data', ''), data.get('format', 'csv'))
+		delta_users = []
+		if not errors:
+			delta_users = self.bulk_update(changes)
+		return {'changes': len(changes) if not errors else 0,
+				'changed_users': [user['user']['user_id'] for user in delta_users],
+				'errors': errors}
+
+	def read_bulk_changes(self, text, data_format):
+		''' translates CSV or NDJSON text into the change list of bulk_update()
+
+		Args:
+		text (:obj:`str`): the changes, one per line
+		data_format (:obj:`str`): 'csv' or 'ndjson'
+
+		Return:
+		changes (:obj:`list`): the change list
+		errors (:obj:`list`): error messages per faulty line
+		'''
+
+		changes = []
+		errors = []
+		if data_format == 'csv':
+			rows = enumerate(csv.DictReader(io.StringIO(text)), start=2)
+		elif data_format == 'ndjson':
+			rows = []
+			for line_nr, line in enumerate(text.splitlines(), start=1):
+				if not line.strip():
+					continue
+				try:
+					rows.append((line_nr, json.loads(line)))
+				except ValueError as ex:
+					errors.append('line {0}: {1}'.format(line_nr, ex))
+		else:
+			return [], ['unknown format {0}'.format(data_format)]
+		known_users = self.snapshot.users
+		granted_ids = set()  # a user who gets a key in an earlier line can already lend it further
+		for line_nr, row in rows:
+			if not isinstance(row, dict):
+				errors.append('line {0}: object expected'.format(line_nr))
+				continue
+			action = row.get('action')
+			sponsor_id = row.get('sponsor_id')
+			user_id = row.get('user_id')
+			if not sponsor_id or not user_id:
+				errors.append('line {0}: sponsor_id and user_id needed'.format(line_nr))
+			elif action == 'grant':
+				if not str(sponsor_id) in known_users and not str(sponsor_id) in granted_ids:
+					errors.append('line {0}: unknown sponsor {1}'.format(line_nr, sponsor_id))
+					continue
+				new_user = self.user_info_by_id(str(user_id))
+				if not new_user or row.get('first_name'):  # keep the known names, if no new ones are given
+					new_user = User(row.get('first_name'), row.get('last_name'), user_id, row.get('language'))
+				changes.append({'action': 'grant', 'sponsor_id': str(sponsor_id), 'user': new_user})
+				granted_ids.add(str(user_id))
+			elif action == 'revoke':
+				changes.append({'action': 'revoke', 'sponsor_id': str(sponsor_id), 'user_id': str(user_id)})
+			else:
+				errors.append('line {0}: unknown action {1}'.format(line_nr, action))
+		return changes, errors
+
 	def dummy(self, user):
 		''' empty procedure for websocket connect/disconnect handler
 		'''
@@ -89,7 +262,7 @@ class AccessManager:
 		''' check user existance and updates user data
 
 		Args:
-		user (:obj:`user`): a user object
+		user (:user:`obj`): a user object
 
 		Return:
 		user object, if known, otherways None
@@ -97,11 +270,41 @@ class AccessManager:
 
 		user_ref = self.user_info_by_id(user["user_id"])
 		if user_ref:  # update the user with the latest just received data
-			self.users['users'][user["user_id"]]['user'] = user
-			return self.users['users'][user["user_id"]]['user']
+			self.update_user_data(user)
+			return user
 		else:
 			return user_ref
 
+	def update_user_data(self, user):
+		''' stores the latest received data (names, language) of a known user
+
+		It's called by readers like user_is_active(), which must not wait for the mutex,
+		so a change is handed over to a worker thread (see store_user_data())
+
+		Args:
+		user (:user:`obj`): a user object
+		'''
+
+		if self.snapshot.users.get(user["user_id"], {}).get('user') == user:
+			return  # nothing to update
+		self.executor.submit(self.store_user_data, user)
+
+	def store_user_data(self, user):
+		''' writes the latest received data (names, language) of a known user into the user table
+
+		Args:
+		user (:user:`obj`): a user object
+		'''
+
+		user_id = user["user_id"]
+		with self.mutex:
+			if user_id in self.users['users'] and self.users['users'][user_id]['user'] != user:
+				self.users['users'][user_id] = {
+					'user': user, 'time_table': self.users['users'][user_id]['time_table']}
+				self.unpublished_users.add(user_id)
+				# just names or language, so no need to wait until it's on disk
+				self.journal_user_data([user_id])
+
 	def user_id(self, user):
 		''' getter for user id
 
@@ -124,12 +327,12 @@ class AccessManager:
 		user object, if active, otherways None
 		'''
 
-		user_ref = self.user_info_by_id(user["user_id"])
-		if user_ref:  # update the user with the latest just received data
-			self.users['users'][user["user_id"]]['user'] = user
+		user_entry = self.snapshot.users.get(user["user_id"])
+		if user_entry:  # update the user with the latest just received data
+			self.update_user_data(user)
 			# return user if user is active
-			if self.users['users'][user["user_id"]]['time_table']:
-				return user_ref
+			if user_entry['time_table']:
+				return user_entry['user']
 		return None
 
 	def user_is_follower(self, current_user, active_user, time_table_id='1'):
@@ -144,12 +347,8 @@ class AccessManager:
 		Boolean
 		'''
 
-		# does the current user already have lend some keys?
-		if not current_user["user_id"] in self.users['timetables']:
-			return False
-		if not active_user["user_id"] in self.users['timetables'][current_user["user_id"]][time_table_id]['users']:
-			return False
-		return self.users['timetables'][current_user["user_id"]][time_table_id]['users'][active_user["user_id"]] == None
+		sponsors = self.snapshot.sponsor_index.get(active_user["user_id"], {})
+		return time_table_id in sponsors.get(current_user["user_id"], ())
 
 	def user_can_lend(self, user):
 		''' returns true if the user is allowed to lend his key further
@@ -161,10 +360,7 @@ class AccessManager:
 		Boolean
 		'''
 
-		for depth in self.users['users'][user["user_id"]]['time_table']:
-			if depth > 0:
-				return True
-		return False
+		return self.snapshot.users[user["user_id"]]['time_table'].max_ttl() > 0
 
 	def add_user(self, current_user, new_user, time_table_id='1'):
 		'''Add a new user to the database
@@ -178,11 +374,18 @@ class AccessManager:
 		list containing all user which have been added or deleted by this operation
 		'''
 
-		old_user_table = self.users['users'].copy()
-		self.users['users'][new_user["user_id"]] = {
-			'user': new_user, 'time_table': None}
+		return self.bulk_update([{'action': 'grant', 'sponsor_id': current_user["user_id"],
+								  'user': new_user, 'time_table_id': time_table_id}])
+
+	def lend_key(self, sponsor_id, new_user, time_table_id='1'):
+		''' adds new_user as follower to the time table of sponsor_id
+
+		Only the time tables are changed, the user table needs to be recalculated afterwards
+		'''
+
+		time_tables = self.writable_time_tables(sponsor_id)
 		# does the current user already have lend some keys?
-		if not current_user["user_id"] in self.users['timetables']:
+		if not time_table_id in time_tables:
 			# if not, create a storage for his lend keys
 			'''
 			each user has a set of timeplans, eacch with it's unique id
@@ -194,12 +397,211 @@ class AccessManager:
 			structures for more complicated time plans are already made now
 			for an eventual later enhancenment
 			'''
-			self.users['timetables'][current_user["user_id"]] = {
-				time_table_id: {'users': {}, 'deletion_timestamp': None}}
+			time_tables[time_table_id] = {'users': ChunkedDict(), 'deletion_timestamp': None}
 		# set the deletion date to None
-		self.users['timetables'][current_user["user_id"]
-								 ][time_table_id]['users'][new_user["user_id"]] = None
-		return self.garbage_collection(old_user_table)
+		time_tables[time_table_id]['users'][new_user["user_id"]] = None
+		self.unpublished_edges[(sponsor_id, time_table_id, new_user["user_id"])] = None
+		self.link_sponsor(sponsor_id, new_user["user_id"], time_table_id)
+
+	def return_key(self, sponsor_id, follower_id):
+		''' sets the deletion date of follower_id in the time tables of sponsor_id
+
+		Only the time tables are changed, the user table needs to be recalculated afterwards
+
+		Return:
+		True, if the follower had an active key of sponsor_id
+		'''
+
+		has_changed = False
+		if sponsor_id in self.users['timetables']:
+			# for later enhancements. Actual there's only the standard id '1'
+			for id, time_table in self.users['timetables'][sponsor_id].items():
+				# if a deletion date is not already set
+				if follower_id in time_table['users'] and not time_table['users'][follower_id]:
+					deletion_timestamp = self.get_unix_timestamp()
+					self.writable_time_tables(sponsor_id)[id]['users'][follower_id] = deletion_timestamp
+					self.unpublished_edges[(sponsor_id, id, follower_id)] = deletion_timestamp
+					self.unlink_sponsor(sponsor_id, follower_id, id)
+					has_changed = True
+		return has_changed
+
+	def writable_time_tables(self, sponsor_id):
+		''' returns the time tables of sponsor_id to be changed
+
+		The follower lists of the time tables are ChunkedDicts, which share their content with the
+		published snapshot, so a change copies only the chunk of the changed follower (copy on write)
+
+		Args:
+		sponsor_id (:str:`str`): id of the sponsor
+		'''
+
+		self.unpublished_sponsors.add(sponsor_id)
+		return self.users['timetables'].setdefault(sponsor_id, {})
+
+	def writable_sponsors(self, follower_id):
+		''' returns the sponsor index entry of follower_id to be changed
+
+		The snapshot gets its own copy of the entry in publish_snapshot(), so it can be changed in place
+
+		Args:
+		follower_id (:str:`str`): id of the follower
+		'''
+
+		self.unpublished_followers.add(follower_id)
+		return self.sponsor_index.setdefault(follower_id, {})
+
+	def journal_user_data(self, user_ids):
+		''' publishes the changes made since the last snapshot and hands them over to the storage journal
+
+		Only the changed key lendings go into the journal, not the whole time tables of their sponsors.
+		Needs to be called with the mutex held
+
+		Args:
+		user_ids (:obj:`list`): ids of the users whose entries have been changed
+
+		Return:
+		journal sequence number to wait for
+		'''
+
+		patch = {'users': {user_id: self.users['users'][user_id] for user_id in user_ids},
+				 'edges': [[sponsor_id, time_table_id, follower_id, deletion_timestamp] for (sponsor_id, time_table_id, follower_id),
+						   deletion_timestamp in self.unpublished_edges.items()],
+				 'stamp': self.users.get('stamp')}
+		self.publish_snapshot()
+		return self.modref.store.journal_users(patch, self.snapshot)
+
+	def config_stamp(self):
+		''' returns a hash of all config values the user table depends on
+		'''
+
+		return hashlib.sha1(json.dumps([STAMP_VERSION, sorted(self.modref.store.get_admin_ids()),
+										self.modref.store.read_config_value(
+											'timetolive', defaults.TIME_TO_LIVE),
+										defaults.TIME_TABLE_SIZE]).encode()).hexdigest()
+
+	def user_table_stamp(self, config_stamp):
+		''' returns the stamp stored together with the user table
+
+		At startup the stored user table is only used, if its stamp still matches the stamp
+		of the actual config and key lendings, otherwise it's calculated again
+
+		Args:
+		config_stamp (:obj:`str`): config_stamp() of the config the user table has been calculated with
+		'''
+
+		return '{0}:{1:016x}'.format(config_stamp, self.edge_checksum)
+
+	def edge_hash(self, sponsor_id, follower_id, time_table_id):
+		''' returns a hash of a key lending, which stays the same between program runs
+		'''
+
+		return int.from_bytes(hashlib.blake2b('\0'.join([sponsor_id, follower_id, time_table_id]).encode(),
+											  digest_size=8).digest(), 'big')
+
+	def publish_snapshot(self):
+		''' makes the actual user data visible for the readers
+
+		The readers (user_is_active(), get_follower_list() etc.) never take the mutex, they just use the last
+		published snapshot, which is replaced as a whole by a single assignment.
+		Only the entries changed since the last publish are copied into the ChunkedDicts of the next snapshot,
+		so the costs grow with the size of the change and not with the size of the user data. The user entries
+		are never changed but replaced, so they're shared with the snapshot as they are.
+		Needs to be called with the mutex held
+		'''
+
+		if len(self.unpublished_users) > len(self.users['users']) // 2:
+			# e.g. after garbage_collection(), building it anew is faster
+			self.snapshot_users = ChunkedDict(self.users['users'])
+		else:
+			for user_id in self.unpublished_users:
+				if user_id in self.users['users']:
+					self.snapshot_users[user_id] = self.users['users'][user_id]
+				else:
+					self.snapshot_users.pop(user_id, None)
+		for sponsor_id in self.unpublished_sponsors:
+			self.snapshot_timetables[sponsor_id] = {
+				time_table_id: {'users': time_table['users'].snapshot(),
+								'deletion_timestamp': time_table['deletion_timestamp']}
+				for time_table_id, time_table in self.users['timetables'][sponsor_id].items()}
+		for follower_id in self.unpublished_followers:
+			if follower_id in self.sponsor_index:
+				self.snapshot_sponsors[follower_id] = {
+					sponsor_id: frozenset(time_table_ids) for sponsor_id, time_table_ids in self.sponsor_index[follower_id].items()}
+			else:
+				self.snapshot_sponsors.pop(follower_id, None)
+		version = self.snapshot.version + 1 if self.snapshot else 1
+		self.snapshot = UserSnapshot(version, self.snapshot_users.snapshot(), self.snapshot_timetables.snapshot(),
+									 self.snapshot_sponsors.snapshot(), self.users.get('stamp'))
+		self.unpublished_users = set()
+		self.unpublished_edges = {}
+		self.unpublished_sponsors = set()
+		self.unpublished_followers = set()
+
+	def bulk_update(self, changes):
+		''' lends and returns many keys in one go
+
+		All changes are made first, then the user table is recalculated and saved only once
+
+		Args:
+		changes (:obj:`list`): list of changes in the order to apply, each either
+				{'action': 'grant', 'sponsor_id': id of the lending user, 'user': the new follower user object,
+					'time_table_id': optional, actual always '1'}
+				{'action': 'revoke', 'sponsor_id': id of the lending user, 'user_id': id of the follower}
+
+		Return:
+		list containing all user which have been added or deleted by this operation
+		'''
+
+		journal_ticket = None
+		self.mutex.acquire()  # avoid thread interfearence
+		try:
+			new_users = {}
+			sponsor_ids = []
+			revoked_ids = []
+			granted_ids = set()
+			for change in changes:  # check all first, to not stop in the middle of the changes
+				if not change['action'] in ['grant', 'revoke']:
+					raise ValueError(
+						"unknown bulk action {0}".format(change['action']))
+				if change['action'] == 'grant':
+					if not change['sponsor_id'] in self.users['users'] and not change['sponsor_id'] in granted_ids:
+						raise ValueError(
+							"unknown sponsor {0}".format(change['sponsor_id']))
+					granted_ids.add(change['user']['user_id'])
+			for change in changes:
+				if change['action'] == 'grant':
+					self.lend_key(change['sponsor_id'], change['user'],
+								  change.get('time_table_id', '1'))
+					new_users[change['user']["user_id"]] = change['user']
+					sponsor_ids.append(change['sponsor_id'])
+				else:
+					if self.return_key(change['sponsor_id'], change['user_id']):
+						revoked_ids.append(change['user_id'])
+			if not new_users and not revoked_ids:
+				return []
+			# first rebuild everything behind the returned keys
+			changed = self.revoke_time_tables(revoked_ids)
+			# a new key can only extend permissions, so it's enough to push the sponsor tables forward
+			for follower_id in new_users:
+				changed.setdefault(
+					follower_id, self.time_table_of(follower_id, changed))
+			self.propagate_time_tables(sponsor_ids, changed)
+			delta_users = self.commit_time_tables(changed, new_users)
+			self.users['stamp'] = self.user_table_stamp(self.user_table_config_stamp)
+			journal_ticket = self.journal_user_data(changed)
+		finally:
+			self.mutex.release()
+		# wait outside of the lock, so parallel changes get written to disk together
+		if journal_ticket is not None:
+			self.modref.store.wait_for_users(journal_ticket)
+		return delta_users
+
+	async def add_user_async(self, current_user, new_user, time_table_id='1'):
+		''' same as add_user(), but runs in a worker thread to not block the event loop
+		'''
+
+		return await asyncio.get_running_loop().run_in_executor(
+			self.executor, functools.partial(self.add_user, current_user, new_user, time_table_id))
 
 	def get_follower_list(self, sponsor_user, time_table_id='1'):
 		'''creates a list of active followers of sponsor_user
@@ -213,12 +615,13 @@ class AccessManager:
 		'''
 
 		res = []
-		if sponsor_user["user_id"] in self.users['timetables']:
+		snapshot = self.snapshot
+		if sponsor_user["user_id"] in snapshot.timetables:
 			# for later enhancements. Actual there's only the standard id '1'
-			for follower_id in self.users['timetables'][sponsor_user["user_id"]][time_table_id]['users']:
+			for follower_id, deletion_timestamp in snapshot.timetables[sponsor_user["user_id"]][time_table_id]['users'].items():
 				# if a deletion date is not already set
-				if not self.users['timetables'][sponsor_user["user_id"]][time_table_id]['users'][follower_id]:
-					res.append({'text': "{0} {1}".format(self.users['users'][follower_id]['user']['first_name'], self.users['users'][follower_id]['user']['last_name']),
+				if not deletion_timestamp:
+					res.append({'text': "{0} {1}".format(snapshot.users[follower_id]['user']['first_name'], snapshot.users[follower_id]['user']['last_name']),
 								"user_id": follower_id})
 		return res
 
@@ -234,14 +637,13 @@ class AccessManager:
 		'''
 
 		res = []
-		follower_id = follower_user["user_id"]
-		for sponsor_user_id in self.users['timetables']:
-			for time_table in self.users['timetables'][sponsor_user_id].values():
-				# important: users can also return keys out of inactive time tables, so we don't check if the table is active
-				# no deletion date set
-				if follower_id in time_table['users'] and not time_table['users'][follower_id]:
-					res.append({'text': "{0} {1}".format(self.users['users'][sponsor_user_id]['user']['first_name'], self.users['users'][sponsor_user_id]['user']['last_name']),
-								"user_id": sponsor_user_id})
+		snapshot = self.snapshot
+		# important: users can also return keys out of inactive time tables, so we don't check if the table is active
+		# the sponsor index contains only lendings without deletion date
+		for sponsor_user_id, time_table_ids in snapshot.sponsor_index.get(follower_user["user_id"], {}).items():
+			for time_table_id in time_table_ids:
+				res.append({'text': "{0} {1}".format(snapshot.users[sponsor_user_id]['user']['first_name'], snapshot.users[sponsor_user_id]['user']['last_name']),
+							"user_id": sponsor_user_id})
 		return res
 
 	def get_unix_timestamp(self):
@@ -276,36 +678,21 @@ class AccessManager:
 		''' overlays time tables
 
 		this routine takes a follower_table and add all new sponsor_table permissions, if there is something to add
-		it returnes the potentially amed follower_table
+		it returnes the potentially amed follower_table as new time table, the given tables are not changed
 
 		Args:
-		sponsor_table (:time_table:`dict`): a time table dict
-		time_table (:obj:`obj`): ? not used yet
-		follower_table (:time_table:`dict`): a time table dict
+		sponsor_table (:time_table:`TimeTable`): a time table
+		ruleset (:obj:`obj`): ? not used yet, per default all slots are allowed
+		follower_table (:time_table:`TimeTable`): a time table or None
 		Return:
-		follower_table (:time_table:`dict`): a time table dict
+		follower_table (:time_table:`TimeTable`): a time table
 		'''
 
 		if not follower_table:  # no table yet?
-			follower_table = []
-			for i in range(defaults.TIME_TABLE_SIZE):  # for each entry slot
-				follower_table.append(-1)  # per default nothing allowed
-
-		# create ruleset mask
-		# just a dummy for now, creates a fully packed ruleset
-		ruleset_table = []
-		for i in range(defaults.TIME_TABLE_SIZE):  # foreach entry slot
-			ruleset_table.append(True)  # per default all set
-
-		for i in range(defaults.TIME_TABLE_SIZE):  # for each entry slot
-			if ruleset_table[i]:  # if the ruleset allows access, then
-				sponsor_ttl = sponsor_table[i]
-				if sponsor_ttl > 0:
-					new_ttl = sponsor_ttl-1  # we reduce the ttl by 1
-					# does the new ttl improve the depth level?
-					if follower_table[i] < new_ttl:
-						follower_table[i] = new_ttl
-		return follower_table
+			follower_table = TimeTable.empty()  # per default nothing allowed
+		# each slot allowed by the ruleset with a sponsor ttl > 0 is passed with the ttl reduced by 1,
+		# if this improves the depth level of the follower
+		return follower_table.overlay(sponsor_table.follow(ruleset))
 
 	def garbage_collection(self, old_user_table):
 		''' cleans up user and time plan tables
@@ -313,6 +700,10 @@ class AccessManager:
 		as this might be time consuming, it's placed in a procedure
 		which could be called by a seperate clean-up thread
 
+		It recalculates the whole user table, so it's only used for the initial build and after
+		changes of the admins or the timetolive (see apply_config()).
+		add_user() and delete_user_by_id() update just the affected users instead
+
 		Args:
 		old_user_table (:obj:`obj`): hash containing all active users as copy
 
@@ -321,67 +712,59 @@ class AccessManager:
 		'''
 
 		self.mutex.acquire()  # avoid thread interfearence
-		new_user_table = {}
-		# admins are always walid
-		admin_list = self.modref.store.get_admin_ids()
-		for admin in admin_list:
-			new_user_table[admin] = {'user': self.users['users'][admin]
-									 ['user'], 'time_table': self.modref.store.create_full_time_table()}
-			# after startup the admins do not have a valid full time table, so we correct this here
-			if not self.users['users'][admin]['time_table']:
-				self.users['users'][admin]['time_table'] = self.modref.store.create_full_time_table()
-
-		for user_id in self.users['timetables']:  # go through all sponsor users
-			# go through all the users time_tables
-			for time_table_id in self.users['timetables'][user_id]:
-				# if active,
-				if self.time_table_is_active(self.users['timetables'][user_id][time_table_id]):
-					# go through all followers
-					for follower_id in self.users['timetables'][user_id][time_table_id]['users']:
-						# copy of all included followers into the new user table
-						if not follower_id in new_user_table:  # if no deletion datetime is set, then
-							new_user_table[follower_id] = {
-								'user': self.users['users'][follower_id]['user'], 'time_table': None}
-
-		'''and now we calculate the allowance, starting with the admin users and repeating the loop,
-		until all valid users have got their time table derivated from their sponsors
-
-		That might give a faulty result in the rare case that two users have invited each other cross-over.
-		might this give a faulty time table?
-
-		'''
-		something_has_changed = True
-		while something_has_changed:
-			something_has_changed = False
-			for user_id in self.users['timetables']:
-				# the user has a time table, so he's either a admin or another already validated user
-				if user_id in new_user_table and new_user_table[user_id]['time_table'] != None:
-					for time_table_id in self.users['timetables'][user_id]:
-						if self.time_table_is_active(self.users['timetables'][user_id][time_table_id]):
-							for follower_id in self.users['timetables'][user_id][time_table_id]['users']:
-								# there is no date set, so the follower is active
-								if not self.users['timetables'][user_id][time_table_id]['users'][follower_id]:
-									# did this user already had a time table before?
-									if not new_user_table[follower_id]['time_table']:
-										something_has_changed = True
-									new_user_table[follower_id]['time_table'] = self.calculate_follower_time_table(
-										new_user_table[user_id]['time_table'], None, new_user_table[follower_id]['time_table'])
-
-		# Reminder: If a users ['time_table'] is None, then the user is still anywhere in a time plan, but not avtive anymore
-
-		# the new_user_table contains now all users, so it replaces the original global table
-		self.users['users'] = new_user_table
-
-		# now we prepare to identify the user add & deletes
-		delta_users = []
-		for user_id, user in new_user_table.items():
-			if not user_id in old_user_table or user['time_table'] != None and old_user_table[user_id]['time_table'] == None:
-				delta_users.append(user)
-		for user_id, user in old_user_table.items():
-			if not user_id in new_user_table or user['time_table'] != None and new_user_table[user_id]['time_table'] == None:
-				delta_users.append(user)
-		# finally we store the new calculated user data
 		try:
+			# new admins might have been added to the config since the last time
+			self.modref.store.create_new_admins_if_any()
+			self.user_table_config_stamp = self.config_stamp()
+			changed = {}
+			# admins are always walid
+			admin_list = self.modref.store.get_admin_ids()
+			for admin in admin_list:
+				changed[admin] = self.modref.store.create_full_time_table()
+				# after startup the admins do not have a valid full time table, so we correct this here
+				if not self.users['users'][admin]['time_table']:
+					self.users['users'][admin] = {'user': self.users['users'][admin]['user'],
+												  'time_table': self.modref.store.create_full_time_table()}
+
+			for user_id in self.users['timetables']:  # go through all sponsor users
+				# go through all the users time_tables
+				for time_table_id in self.users['timetables'][user_id]:
+					# if active,
+					if self.time_table_is_active(self.users['timetables'][user_id][time_table_id]):
+						# the sponsor stays known, also when he's not active anymore (e.g. a former admin)
+						if user_id in self.users['users'] and not user_id in changed:
+							changed[user_id] = None
+						# go through all followers
+						for follower_id in self.users['timetables'][user_id][time_table_id]['users']:
+							# copy of all included followers into the new user table
+							if not follower_id in changed:  # if no deletion datetime is set, then
+								changed[follower_id] = None
+
+			# and now we calculate the allowance, starting with the admin users
+			self.propagate_time_tables(admin_list, changed)
+
+			# Reminder: If a users ['time_table'] is None, then the user is still anywhere in a time plan, but not avtive anymore
+
+			new_user_table = {}
+			for user_id, time_table in changed.items():
+				new_user_table[user_id] = {
+					'user': self.users['users'][user_id]['user'], 'time_table': time_table}
+			# the new_user_table contains now all users, so it replaces the original global table
+			self.unpublished_users.update(self.users['users'])
+			self.unpublished_users.update(new_user_table)
+			self.users['users'] = new_user_table
+			self.users['stamp'] = self.user_table_stamp(self.user_table_config_stamp)
+			self.publish_snapshot()
+
+			# now we prepare to identify the user add & deletes
+			delta_users = []
+			for user_id, user in new_user_table.items():
+				if not user_id in old_user_table or user['time_table'] != None and old_user_table[user_id]['time_table'] == None:
+					delta_users.append(user)
+			for user_id, user in old_user_table.items():
+				if not user_id in new_user_table or user['time_table'] != None and new_user_table[user_id]['time_table'] == None:
+					delta_users.append(user)
+			# finally we store the new calculated user data
 			self.modref.store.write_users()
 		finally:
 			# release the mutex lock
@@ -389,6 +772,213 @@ class AccessManager:
 		# and return the add/delete list
 		return delta_users
 
+	def build_sponsor_index(self):
+		''' builds the reverse follower -> sponsors index out of the time tables
+
+		The index contains all key lendings without deletion date, so the sponsors of a
+		follower can be found without going through the time tables of all users.
+		It's made at load time and kept up to date by add_user() and delete_user_by_id()
+		'''
+
+		# the followers of the old index need to be removed from the next snapshot
+		self.unpublished_followers.update(self.sponsor_index)
+		self.sponsor_index = {}
+		self.edge_checksum = 0
+		# the follower lists are kept as ChunkedDicts, see writable_time_tables()
+		for sponsor_id, time_tables in self.users['timetables'].items():
+			for time_table in time_tables.values():
+				if not isinstance(time_table['users'], ChunkedDict):
+					time_table['users'] = ChunkedDict(time_table['users'])
+			self.unpublished_sponsors.add(sponsor_id)
+		# the storage backend knows best how to find them
+		for sponsor_id, time_table_id, follower_id in self.modref.store.get_active_edges():
+			self.link_sponsor(sponsor_id, follower_id, time_table_id)
+
+	def link_sponsor(self, sponsor_id, follower_id, time_table_id):
+		''' notes in the sponsor index that sponsor_id has lend a key to follower_id
+		'''
+
+		time_table_ids = self.writable_sponsors(follower_id).setdefault(sponsor_id, set())
+		if not time_table_id in time_table_ids:
+			time_table_ids.add(time_table_id)
+			self.edge_checksum ^= self.edge_hash(sponsor_id, follower_id, time_table_id)
+
+	def unlink_sponsor(self, sponsor_id, follower_id, time_table_id):
+		''' removes a key lending from the sponsor index
+		'''
+
+		sponsors = self.writable_sponsors(follower_id)
+		time_table_ids = sponsors.get(sponsor_id, set())
+		if time_table_id in time_table_ids:
+			time_table_ids.discard(time_table_id)
+			self.edge_checksum ^= self.edge_hash(sponsor_id, follower_id, time_table_id)
+		if not time_table_ids:
+			sponsors.pop(sponsor_id, None)
+		if not sponsors:
+			self.sponsor_index.pop(follower_id, None)
+
+	def active_followers(self, sponsor_id):
+		''' yields the ids of all followers sponsor_id has lend an active key to
+
+		Args:
+		sponsor_id (:str:`str`): id of the sponsor
+		'''
+
+		for time_table in self.users['timetables'].get(sponsor_id, {}).values():
+			if self.time_table_is_active(time_table):
+				for follower_id, deletion_timestamp in time_table['users'].items():
+					if not deletion_timestamp:  # no deletion date set
+						yield follower_id
+
+	def active_sponsors(self, follower_id):
+		''' yields the ids of all sponsors which have lend an active key to follower_id
+
+		Args:
+		follower_id (:str:`str`): id of the follower
+		'''
+
+		for sponsor_id, time_table_ids in self.sponsor_index.get(follower_id, {}).items():
+			for time_table_id in time_table_ids:
+				if self.time_table_is_active(self.users['timetables'][sponsor_id][time_table_id]):
+					yield sponsor_id
+					break
+
+	def time_table_of(self, user_id, changed):
+		''' returns the time table of a user, preferring a not yet committed one out of changed
+
+		Args:
+		user_id (:str:`str`): id of the user
+		changed (:obj:`dict`): user_id -> time table of the not yet committed changes
+		'''
+
+		if user_id in changed:
+			return changed[user_id]
+		if user_id in self.users['users']:
+			return self.users['users'][user_id]['time_table']
+		return None
+
+	def propagate_time_tables(self, sponsor_ids, changed):
+		''' pushes the time tables of sponsor_ids forward to their followers and further on,
+		as long as this improves the follower time tables
+
+		The users are handled in a priority queue ordered by their highest remaining TTL.
+		As each key lend reduces the TTL by 1, a user can't be improved anymore by the users
+		handled after him, so each user is settled once with his best TTL - also when users have
+		lend their keys to each other in circles or over multiple ways. Only when the time table slots
+		are reached over different ways, a user might be queued again for the improved slots.
+
+		Only the users reached by an improvement are visited, so the costs grow with the size
+		of the change and not with the size of the whole user database
+
+		Args:
+		sponsor_ids (:obj:`list`): ids of the users to start from
+		changed (:obj:`dict`): user_id -> time table of the not yet committed changes, will be amend
+		'''
+
+		admin_list = self.modref.store.get_admin_ids()
+		work = []
+		queued = {}  # user_id -> priority of the user in the queue
+		for sponsor_id in sponsor_ids:
+			self.queue_time_table(work, queued, sponsor_id,
+								  self.time_table_of(sponsor_id, changed))
+		while work:
+			priority, sponsor_id = heapq.heappop(work)
+			if queued.get(sponsor_id) != priority:  # outdated queue entry
+				continue
+			del queued[sponsor_id]
+			sponsor_table = self.time_table_of(sponsor_id, changed)
+			for follower_id in self.active_followers(sponsor_id):
+				if follower_id in admin_list:  # admins have always the full time table
+					continue
+				new_table = self.calculate_follower_time_table(
+					sponsor_table, None, self.time_table_of(follower_id, changed))
+				if new_table != self.time_table_of(follower_id, changed):
+					changed[follower_id] = new_table
+					self.queue_time_table(work, queued, follower_id, new_table)
+
+	def queue_time_table(self, work, queued, user_id, time_table):
+		''' puts a user into the priority queue of propagate_time_tables(), if he's not already in with a higher TTL
+
+		Args:
+		work (:obj:`list`): heap of (negative TTL, user_id) tuples
+		queued (:obj:`dict`): user_id -> priority of the user in the queue
+		user_id (:str:`str`): id of the user
+		time_table (:time_table:`TimeTable`): the time table of the user
+		'''
+
+		if time_table is None:  # inactive users can't pass any permissions
+			return
+		priority = -time_table.max_ttl()  # highest TTL first
+		if user_id in queued and queued[user_id] <= priority:
+			return
+		queued[user_id] = priority
+		heapq.heappush(work, (priority, user_id))
+
+	def revoke_time_tables(self, user_ids):
+		''' recalculates the time tables of user_ids and all users who got their key from them, after
+		the user_ids have lost one of their keys
+
+		Args:
+		user_ids (:obj:`list`): ids of the users who lost a key
+
+		Return:
+		dict user_id -> time table of all changed time tables
+		'''
+
+		admin_list = self.modref.store.get_admin_ids()
+		# collect all users who got their keys directly or indirectly from user_ids
+		affected = set()
+		work = list(user_ids)
+		while work:
+			follower_id = work.pop()
+			if follower_id in affected or follower_id in admin_list:
+				continue
+			affected.add(follower_id)
+			work.extend(self.active_followers(follower_id))
+		# rebuild their time tables, starting with the keys they got from outside of the affected users
+		changed = {follower_id: None for follower_id in affected}
+		start_ids = []
+		for follower_id in affected:
+			for sponsor_id in self.active_sponsors(follower_id):
+				if sponsor_id in affected:
+					continue
+				sponsor_table = self.time_table_of(sponsor_id, changed)
+				if sponsor_table is not None:
+					changed[follower_id] = self.calculate_follower_time_table(
+						sponsor_table, None, changed[follower_id])
+			if changed[follower_id] is not None:
+				start_ids.append(follower_id)
+		self.propagate_time_tables(start_ids, changed)
+		return changed
+
+	def commit_time_tables(self, changed, user_data=None):
+		''' writes the new calculated time tables into the user table
+
+		Args:
+		changed (:obj:`dict`): user_id -> new time table
+		user_data (:obj:`dict`): user_id -> optional new user object
+
+		Return:
+		list containing all user which have been added or deleted by this operation
+		'''
+
+		delta_users = []
+		for user_id, time_table in changed.items():
+			old_user = self.users['users'].get(user_id)
+			if user_data and user_id in user_data:
+				user = user_data[user_id]
+			else:
+				user = old_user['user']
+			# the user entries are replaced, not changed, so old references keep their content
+			new_user = {'user': user, 'time_table': time_table}
+			self.users['users'][user_id] = new_user
+			self.unpublished_users.add(user_id)
+			if not old_user or time_table != None and old_user['time_table'] == None:
+				delta_users.append(new_user)
+			elif time_table == None and old_user['time_table'] != None:
+				delta_users.append(old_user)
+		return delta_users
+
 	def delete_user_by_id(self, current_user_id, delete_user_id):
 		''' makes a user inactive by set his deletion date in the follower table
 
@@ -400,15 +990,15 @@ class AccessManager:
 		list containing all user which have been added or deleted by this operation
 		'''
 
-		if current_user_id in self.users['timetables']:
-			# for later enhancements. Actual there's only the standard id '1'
-			for id in self.users['timetables'][current_user_id]:
-				if delete_user_id in self.users['timetables'][current_user_id][id]['users']:
-					# if a deletion date is not already set
-					if not self.users['timetables'][current_user_id][id]['users'][delete_user_id]:
-						self.users['timetables'][current_user_id
-												 ][id]['users'][delete_user_id] = self.get_unix_timestamp()
-		return self.garbage_collection(self.users['users'].copy())
+		return self.bulk_update([{'action': 'revoke', 'sponsor_id': current_user_id,
+								  'user_id': delete_user_id}])
+
+	async def delete_user_by_id_async(self, current_user_id, delete_user_id):
+		''' same as delete_user_by_id(), but runs in a worker thread to not block the event loop
+		'''
+
+		return await asyncio.get_running_loop().run_in_executor(
+			self.executor, self.delete_user_by_id, current_user_id, delete_user_id)
 
 	def user_info_by_id(self, user_id):
 		''' finds a user by his id
@@ -420,9 +1010,61 @@ class AccessManager:
 		user if found, otherways None
 		'''
 
-		if not user_id in self.users['users']:
+		users = self.snapshot.users
+		if not user_id in users:
 			return None
-		return self.users['users'][user_id]['user']
+		return users[user_id]['user']
+
+	def open_otp_request(self, user, deliver):
+		''' registers a new OTP request and sends it to the smart home
+
+		Args:
+		user (:user:`obj`): user data
+		deliver (:func:`function`): called with the answer of the smart home (in websocket context)
+
+		Return:
+		request_id (:str:`str`): the unique id of the request
+		'''
+
+		request_id = secrets.token_hex(8)
+		with self.otp_requests_mutex:
+			self.otp_requests[request_id] = deliver
+		# the smart home shall send the request_id back with its answer
+		otp_request = dict(user)
+		otp_request['request_id'] = request_id
+		self.smart_home_interface.emit("otprequest", otp_request)
+		return request_id
+
+	def close_otp_request(self, request_id):
+		''' removes a OTP request after it's answered or timed out
+		'''
+
+		with self.otp_requests_mutex:
+			self.otp_requests.pop(request_id, None)
+
+	def answer_otp_request(self, data):
+		''' passes a ac_otprequest answer to the waiting request
+
+		the request is identified by the request_id send back by the smart home.
+		As not all smart home flows send the request_id back, answers without id go
+		to the oldest waiting request
+
+		Args:
+		data (:obj:`obj`): ac_otprequest message
+		'''
+
+		request_id = None
+		if isinstance(data.get('config'), dict):
+			request_id = data['config'].get('request_id')
+		with self.otp_requests_mutex:
+			if request_id in self.otp_requests:
+				deliver = self.otp_requests.pop(request_id)
+			elif request_id is None and self.otp_requests:
+				request_id, deliver = self.otp_requests.popitem(last=False)
+			else:
+				logger.debug('answer for unknown or timed out OTP request {0}'.format(request_id))
+				return
+		deliver(data)
 
 	def requestOTP(self, user):
 		''' gets a unique one time password string
@@ -430,6 +1072,9 @@ class AccessManager:
 		returns an object containing a OTP (if permitted from Smart Home),
 		how long it should be valid, optional message
 
+		Each request gets its own request_id, so several requests can wait in parallel
+		for their smart home answers
+
 		Args:
 		user (:user:`obj`): user data
 
@@ -441,9 +1086,57 @@ class AccessManager:
 				an optional message
 		'''
 
-		with self.queue.mutex:
-			self.queue.queue.clear()
-		self.smart_home_interface.emit("otprequest", user)
+		answer_queue = queue.Queue(maxsize=1)
+		request_id = self.open_otp_request(user, answer_queue.put)
+		try:
+			data = answer_queue.get(
+				block=True, timeout=defaults.SMART_HOME_TIMEOUT)
+		except queue.Empty:
+			data = None
+		finally:
+			self.close_otp_request(request_id)
+		return self.create_otp(data)
+
+	async def requestOTP_async(self, user):
+		''' same as requestOTP(), but waits for the smart home answer without blocking the event loop
+		'''
+
+		loop = asyncio.get_running_loop()
+		answer = loop.create_future()
+
+		def deliver(data):
+			loop.call_soon_threadsafe(self.set_future_result, answer, data)
+
+		request_id = await loop.run_in_executor(self.executor, self.open_otp_request, user, deliver)
+		try:
+			data = await asyncio.wait_for(answer, defaults.SMART_HOME_TIMEOUT)
+		except asyncio.TimeoutError:
+			data = None
+		finally:
+			self.close_otp_request(request_id)
+		return self.create_otp(data)
+
+	def set_future_result(self, future, result):
+		''' sets the result of a future, if nobody has given up waiting for it already
+		'''
+
+		if not future.done():
+			future.set_result(result)
+
+	def create_otp(self, data):
+		''' creates the one time password out of the smart home answer
+
+		Args:
+		data (:obj:`obj`): ac_otprequest message of the smart home or None, if there was no answer
+
+		Return:
+		object containing
+				an OTP string (if permitted from Smart Home),
+				the OTP type (qrcode or others)
+				how long it should be valid in secs
+				an optional message
+		'''
+
 		valid_time = 0
 		msg_text = ""
 		otp_type = 'qrcode'
@@ -452,8 +1145,6 @@ class AccessManager:
 		"""Generate a secure random string of letters, digits and special characters """
 		password_characters = string.ascii_letters + string.digits + string.punctuation
 		try:
-			data = self.queue.get(
-				block=True, timeout=defaults.SMART_HOME_TIMEOUT)
 			logger.debug(
 				'data received from smart home {0}'.format(repr(data)))
 			if data['config']['result'] == True:
@@ -466,10 +1157,20 @@ class AccessManager:
 				password_characters = password_characters.replace("\"", "").replace(
 					"\\", "").replace(":", "")  # everthing but without " and :"
 
-				otp = ''.join(secrets.choice(password_characters)
-							  for i in range(stringLength))
-				self.current_tokens[otp] = datetime.datetime.now().timestamp(
-				)+valid_time  # store, until when the token shall be valid
+				# store, until when the token shall be valid
+				valid_until = datetime.datetime.now().timestamp()+valid_time
+				for attempt in range(defaults.OTP_CREATE_ATTEMPTS):
+					new_otp = ''.join(secrets.choice(password_characters)
+									  for i in range(stringLength))
+					# a short keypad pin might be already in use by somebody else
+					if self.current_tokens.add(new_otp, valid_until):
+						otp = new_otp
+						break
+					if self.current_tokens.is_full():
+						break
+				if not otp:
+					logger.warning('no unused token available')
+					valid_time = 0
 			else:
 				msg_text = data['config']['msg']
 		except:
@@ -486,25 +1187,38 @@ class AccessManager:
 		boolean True if valid
 		'''
 
-		# first delete any old left-over
 		logger.debug('token: {0}'.format(token))
-		to_del = []
-		now = datetime.datetime.now().timestamp()
-		for old_token, timestp in self.current_tokens.items():
-			if timestp + 5 * 60 < now:  # is the token expired more as 5 mins ago?
-				to_del.append(old_token)
-		for old_token in to_del:
-			del(self.current_tokens[old_token])
-
 		# is is a service token?
-		if token[:2] == "zm" and ':' in token:  # is is a service token?
-			return idcard.verify_message(token.split(':')[1:], self.modref)
-		if not token in self.current_tokens:
-			return False
-		timestp = self.current_tokens[token]
-		if timestp < now:  # is the token expired already?
+		if token[:2].lower() == "zm" and ':' in token:  # is is a service token?
+			return self.validate_service_token(token)
+		return self.current_tokens.is_valid(token)
+
+	def validate_service_token(self, token):
+		''' checks the signature of a service token
+
+		A scanner reads the same token many times until the door opens, so verified tokens are
+		remembered until they get too old. If the config value 'single_use_service_tokens' is set,
+		a token is only accepted the first time instead
+
+		Args:
+		token (:str:`str`): token string
+
+		Return:
+		boolean True if valid
+		'''
+
+		single_use = self.modref.store.read_config_value(
+			'single_use_service_tokens', False)
+		if self.verified_service_tokens.is_valid(token):
+			if single_use:
+				logger.info('service token used again')
+				return False
+			return True
+		lifetime = idcard.token_lifetime(token, self.modref)
+		if lifetime is None:
 			return False
-		return True
+		# remembering a single use token is a must, otherwise it could be used again
+		return self.verified_service_tokens.add(token, time.time() + lifetime) or not single_use
 
 	def request_id_card(self, user, receiver, botname):
 		''' generates a service token
@@ -514,10 +1228,261 @@ class AccessManager:
 		botname (:str:`str`): the own bot name
 
 		Return:
-		string  token string
+		string  token string, in the format given by the config value id_card_format
 		'''
 
+		if self.modref.store.read_config_value('id_card_format') == 2:
+			token = idcard.get_id_card_string_v2(
+				self.modref.store, str(self.user_id(user)), receiver, botname)
+			logger.debug('generated token: {0}'.format(token))
+			return idcard.ID_CARD_V2_PREFIX+token
 		token = idcard.get_id_card_string(
 			self.modref.store, str(self.user_id(user)), receiver, botname)
 		logger.debug('generated token: {0}'.format(token))
 		return "zm:"+token
+
+	def make_id_card(self, user, receiver, botname, render=None):
+		''' generates a service token and optionally converts it, e.g. into a QR code image
+
+		Args:
+		user (:str:`str`): user, who has requested the service token
+		receiver (:str:`str`): bot name the token shall be made for
+		botname (:str:`str`): the own bot name
+		render (:func:`function`): optional function to call with the token string
+
+		Return:
+		the token string or the result of render()
+		'''
+
+		token = self.request_id_card(user, receiver, botname)
+		if render:
+			return render(token)
+		return token
+
+	async def request_id_card_async(self, user, receiver, botname, render=None):
+		''' same as make_id_card(), but done by the id card worker threads
+
+		Only ID_CARD_QUEUE_SIZE requests can be running or waiting at the same time,
+		so a burst of requests can't pile up endless work
+
+		Return:
+		the token string or the result of render(), None if there are too many requests just now
+		'''
+
+		if not self.id_card_jobs.acquire(blocking=False):
+			logger.warning("too many id card requests, request refused")
+			return None
+		try:
+			if not self.id_card_executor:
+				return self.make_id_card(user, receiver, botname, render)
+			return await asyncio.get_running_loop().run_in_executor(
+				self.id_card_executor, self.make_id_card, user, receiver, botname, render)
+		finally:
+			self.id_card_jobs.release()
+
+
+if __name__ == '__main__':
+	# checks the time table propagation against some tricky delegation graphs and
+	# measures the time needed for a full recalculation, for single key lends & returns and for bulk changes
+	import random
+	import sys
+	from timetable import json_default
+	from storage import Storage
+
+	class MemoryStore:
+		''' minimal replacement of storage.Storage, which keeps everything in memory
+		'''
+
+		def __init__(self, admins, ttl):
+			self.config = {'admins': admins, 'timetolive': ttl}
+			self.users = {'users': {}, 'timetables': {}}
+			for admin in admins:
+				self.users['users'][admin] = {
+					'user': User(admin, '', admin, 'en'), 'time_table': None}
+
+		def get_users(self):
+			return self.users
+
+		get_active_edges = Storage.get_active_edges
+		create_new_admins_if_any = Storage.create_new_admins_if_any
+
+		def get_admin_ids(self):
+			return self.config['admins']
+
+		def read_config_value(self, key, default=None):
+			return self.config.get(key, default)
+
+		def create_full_time_table(self):
+			return TimeTable.full(self.config['timetolive'])
+
+		def write_users(self, wait=True):
+			# costs the same as the json.dumps() in storage.Storage, just without the disk
+			json.dumps(self.users, sort_keys=True, indent=4,
+					   separators=(',', ': '), default=json_default)
+
+		def journal_users(self, patch, snapshot=None):
+			json.dumps(patch, separators=(',', ':'), default=json_default)
+			return 0
+
+		def wait_for_users(self, sequence):
+			pass
+
+	class MemoryServer:
+		def emit(self, topic, data):
+			pass
+
+	class MemoryModRef:
+		def __init__(self, admins, ttl):
+			self.store = MemoryStore(admins, ttl)
+			self.server = MemoryServer()
+
+	def create_access_manager(edges, admins=['A'], ttl=5):
+		''' builds an access manager out of a list of (sponsor, follower) tuples
+		'''
+
+		access_manager = AccessManager(MemoryModRef(admins, ttl), None)
+		for sponsor_id, follower_id in edges:
+			# bulk_update() refuses unknown sponsors, so the sponsors without a key yet are
+			# added as known, but inactive users, like the ones left over by a key return
+			access_manager.users['users'].setdefault(sponsor_id, {
+				'user': User(sponsor_id, '', sponsor_id, 'en'), 'time_table': None})
+			access_manager.add_user(User(sponsor_id, '', sponsor_id, 'en'),
+									User(follower_id, '', follower_id, 'en'))
+		return access_manager
+
+	def reference_time_tables(access_manager):
+		''' the slow, but obvious calculation: repeat the whole table overlay until nothing changes anymore
+		'''
+
+		tables = {}
+		for admin in access_manager.modref.store.get_admin_ids():
+			tables[admin] = access_manager.modref.store.create_full_time_table()
+		something_has_changed = True
+		while something_has_changed:
+			something_has_changed = False
+			for sponsor_id in access_manager.users['timetables']:
+				if tables.get(sponsor_id) is None:
+					continue
+				for follower_id in access_manager.active_followers(sponsor_id):
+					if follower_id in access_manager.modref.store.get_admin_ids():
+						continue
+					old_table = tables.get(follower_id)
+					new_table = access_manager.calculate_follower_time_table(
+						tables[sponsor_id], None, old_table)
+					if new_table != old_table:
+						tables[follower_id] = new_table
+						something_has_changed = True
+		return tables
+
+	failed_checks = []
+
+	def check(name, access_manager):
+		expected = reference_time_tables(access_manager)
+		result = {user_id: entry['time_table'] for user_id,
+				  entry in access_manager.users['users'].items() if entry['time_table'] is not None}
+		# the readers only see the published snapshot, so it must be the same
+		published = {user_id: entry['time_table'] for user_id,
+					 entry in access_manager.snapshot.users.items() if entry['time_table'] is not None}
+		if published != result:
+			result = 'published {0}'.format(published)
+		if result != expected:
+			failed_checks.append(name)
+		print('{0:40} {1}'.format(name, 'ok' if result == expected else 'FAILED {0} != {1}'.format(result, expected)))
+
+	# the higher TTL arrives later over a second, shorter way and must be passed further down
+	check('late better path', create_access_manager(
+		[('B', 'C'), ('C', 'D'), ('D', 'E'), ('A', 'B'), ('A', 'D')]))
+	check('diamond', create_access_manager(
+		[('A', 'B'), ('A', 'C'), ('B', 'D'), ('C', 'D'), ('D', 'E')]))
+	check('uneven diamond', create_access_manager(
+		[('A', 'B'), ('B', 'C'), ('C', 'D'), ('A', 'D'), ('D', 'E'), ('E', 'F')]))
+	check('users invited each other', create_access_manager(
+		[('A', 'B'), ('B', 'C'), ('C', 'B'), ('C', 'D')]))
+	check('cycle without admin', create_access_manager(
+		[('B', 'C'), ('C', 'D'), ('D', 'B')]))
+	access_manager = create_access_manager(
+		[('A', 'B'), ('B', 'C'), ('C', 'D'), ('D', 'B'), ('A', 'E'), ('E', 'D')])
+	access_manager.delete_user_by_id('A', 'B')
+	check('cycle after key return', access_manager)
+	access_manager.delete_user_by_id('A', 'E')
+	check('cycle after last key return', access_manager)
+	access_manager = create_access_manager(
+		[('A', 'B'), ('A', 'X'), ('X', 'B')], admins=['A', 'X'])
+	access_manager.delete_user_by_id('A', 'B')
+	check('second admin keeps the key', access_manager)
+	# config changes made at runtime through write_config()
+	access_manager = create_access_manager([('A', 'B'), ('B', 'C'), ('A', 'D')])
+	access_manager.modref.store.config['admins'] = ['A', 'Z']
+	access_manager.apply_config()
+	check('admin added at runtime', access_manager)
+	access_manager.modref.store.config['admins'] = ['Z']
+	access_manager.apply_config()
+	check('admin removed at runtime', access_manager)
+	access_manager.add_user(User('Z', '', 'Z', 'en'), User('B', '', 'B', 'en'))
+	access_manager.modref.store.config['timetolive'] = 3
+	access_manager.apply_config()
+	check('timetolive changed at runtime', access_manager)
+	if failed_checks:
+		sys.exit(1)
+
+	print()
+	print('{0:>8} {1:>16} {2:>12} {3:>12}'.format(
+		'users', 'full calc (ms)', 'lend (ms)', 'return (ms)'))
+	random.seed(42)
+	for size in [1000, 2000, 4000, 8000, 16000]:
+		# random delegation graph: every user got a key from one or two of the users created before
+		edges = []
+		for follower_nr in range(1, size):
+			for sponsor_nr in set(random.randrange(max(0, follower_nr - 50), follower_nr) for i in range(random.randint(1, 2))):
+				edges.append((str(sponsor_nr), str(follower_nr)))
+		access_manager = AccessManager(MemoryModRef(['0'], 5), None)
+		for sponsor_id, follower_id in edges:
+			time_tables = access_manager.users['timetables'].setdefault(
+				sponsor_id, {'1': {'users': {}, 'deletion_timestamp': None}})
+			time_tables['1']['users'][follower_id] = None
+			access_manager.users['users'][follower_id] = {
+				'user': User(follower_id, '', follower_id, 'en'), 'time_table': None}
+		access_manager.build_sponsor_index()
+		start = time.perf_counter()
+		access_manager.garbage_collection(access_manager.users['users'].copy())
+		full_time = time.perf_counter() - start
+		lend_time = return_time = 0
+		for i in range(20):
+			sponsor_id, follower_id = str(random.randrange(size)), str(random.randrange(size))
+			start = time.perf_counter()
+			access_manager.add_user(User(sponsor_id, '', sponsor_id, 'en'),
+									User(follower_id, '', follower_id, 'en'))
+			lend_time += time.perf_counter() - start
+			start = time.perf_counter()
+			access_manager.delete_user_by_id(sponsor_id, follower_id)
+			return_time += time.perf_counter() - start
+		print('{0:>8} {1:>16.2f} {2:>12.3f} {3:>12.3f}'.format(
+			size, full_time * 1000, lend_time * 1000 / 20, return_time * 1000 / 20))
+
+	print()
+	print('{0:>8} {1:>8} {2:>16} {3:>12}'.format(
+		'users', 'changes', 'single (ms)', 'bulk (ms)'))
+	for size in [1000, 4000]:
+		for change_count in [10, 100]:
+			results = []
+			for bulk in [False, True]:
+				random.seed(size)
+				access_manager = AccessManager(MemoryModRef(['0'], 5), None)
+				access_manager.bulk_update([{'action': 'grant', 'sponsor_id': str(random.randrange(follower_nr)),
+											 'user': User(str(follower_nr), '', str(follower_nr), 'en')} for follower_nr in range(1, size)])
+				changes = []
+				for i in range(change_count):
+					sponsor_id, follower_id = str(random.randrange(size)), str(size + i)
+					changes.append({'action': 'grant', 'sponsor_id': sponsor_id,
+									'user': User(follower_id, '', follower_id, 'en')})
+					if i % 4 == 3:  # and a few returned keys
+						changes.append({'action': 'revoke', 'sponsor_id': sponsor_id, 'user_id': follower_id})
+				start = time.perf_counter()
+				if bulk:
+					access_manager.bulk_update(changes)
+				else:
+					for change in changes:
+						access_manager.bulk_update([change])
+				results.append(time.perf_counter() - start)
+			print('{0:>8} {1:>8} {2:>16.1f} {3:>12.1f}'.format(
+				size, len(changes), results[0] * 1000, results[1] * 1000))
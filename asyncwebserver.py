@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+HTTP and websocket server based on asyncio streams
+
+Alternative to the ThreadedHTTPServer of webserver.py: all connections are handled by one event loop,
+so an idle websocket client costs only its buffers instead of an own thread.
+The incoming websocket messages are dispatched to the registered modules by a small thread pool,
+one message of a connection after the other, as the module handlers may block.
+
+Select it by "backend": "asyncio" in the server_config
+'''
+
+import os
+import asyncio
+import mimetypes
+import posixpath
+import email.utils
+import urllib.parse
+from base64 import b64encode
+from hashlib import sha1
+from concurrent.futures import ThreadPoolExecutor
+
+import defaults
+import wsframe
+import webserver
+import zuullogger
+
+logger = zuullogger.getLogger(__name__)
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized',
+				404: 'File not found', 501: 'Unsupported method'}
+
+
+class AsyncFrameReader(wsframe.FrameReader):
+	''' reads websocket messages out of an asyncio.StreamReader
+	'''
+
+	async def read_message(self):
+		''' reads the next message, see wsframe.FrameReader.parse_message()
+
+		Return:
+		tuple of opcode and payload, None if the connection has been closed
+		'''
+
+		parser = self.parse_message()
+		try:
+			length = next(parser)
+			while True:
+				length = parser.send(await self.rfile.readexactly(length))
+		except StopIteration as result:
+			return result.value
+		except asyncio.IncompleteReadError:
+			return None
+
+
+class AsyncWebSocketConnection(webserver.WSZuulDispatcher):
+	''' a single websocket connection
+
+	send_message() can be called from any thread, the frames are handed over to the event loop
+	and sent in order by the writer task of the connection
+	'''
+
+	def __init__(self, server, reader, writer):
+		'''
+		Args:
+		server (:obj:`AsyncHTTPServer`): the server the connection belongs to
+		reader (:obj:`asyncio.StreamReader`): incoming data
+		writer (:obj:`asyncio.StreamWriter`): outgoing data
+		'''
+
+		self.server = server
+		self.loop = server.loop
+		self.writer = writer
+		self.frame_reader = AsyncFrameReader(reader, server.max_message_size)
+		self.send_queue = asyncio.Queue(server.send_queue_size)
+		self.closing = False
+		self.client_address = writer.get_extra_info('peername')
+
+	def log_message(self, format, *args):
+		logger.info("%s - %s" % (self.client_address, format % args))
+
+	def send_message(self, message):
+		self._send_message(wsframe.OPCODE_TEXT, message)
+
+	def _send_message(self, opcode, message):
+		self.send_frame(wsframe.encode_frame(opcode, message))
+
+	def send_frame(self, frame):
+		''' queues an already encoded frame, see wsframe.encode_frame()
+		'''
+
+		self.loop.call_soon_threadsafe(self._queue_frame, frame)
+
+	def _queue_frame(self, frame):
+		if self.closing:
+			return
+		try:
+			self.send_queue.put_nowait(frame)
+		except asyncio.QueueFull:
+			self.log_message("SND: Close connection: send queue full")
+			self.closing = True
+			self.writer.transport.abort()
+
+	async def _write_frames(self):
+		while True:
+			frame = await self.send_queue.get()
+			if frame is None:
+				return
+			try:
+				self.writer.write(frame)
+				await self.writer.drain()
+			except (ConnectionError, OSError) as e:
+				self.log_message("SND: Close connection: Socket Error %s" % str(e.args))
+				self.closing = True
+				self.writer.transport.abort()
+				return
+
+	async def run(self):
+		''' handles the connection until it's closed
+		'''
+
+		executor = self.server.executor
+		writer_task = self.loop.create_task(self._write_frames())
+		await self.loop.run_in_executor(executor, self.on_ws_connected)
+		try:
+			while True:
+				message = await self.frame_reader.read_message()
+				if message is None:
+					break
+				opcode, payload = message
+				if opcode == wsframe.OPCODE_CLOSE:
+					self._queue_frame(wsframe.encode_frame(wsframe.OPCODE_CLOSE, b''))
+					break
+				elif opcode == wsframe.OPCODE_PING:
+					self._queue_frame(wsframe.encode_frame(wsframe.OPCODE_PONG, payload))
+				elif opcode != wsframe.OPCODE_PONG:
+					# one message after the other, like the threaded server does
+					await self.loop.run_in_executor(executor, self.on_ws_message, payload)
+		except wsframe.WebSocketError as e:
+			self.log_message("RCV: Close connection: %s" % str(e.args))
+			self._queue_frame(wsframe.encode_frame(wsframe.OPCODE_CLOSE, b''))
+		except (ConnectionError, OSError) as e:
+			self.log_message("RCV: Close connection: Socket Error %s" % str(e.args))
+		finally:
+			await self.loop.run_in_executor(executor, self.on_ws_closed)
+			if self.closing:  # aborted already
+				writer_task.cancel()
+			else:
+				# let the writer send the frames queued so far, the close frame included
+				self._queue_frame(None)
+				self.closing = True
+				try:
+					await asyncio.wait_for(writer_task, self.server.writer_stop_timeout)
+				except asyncio.TimeoutError:
+					self.writer.transport.abort()
+
+
+class AsyncHTTPServer(webserver.ModuleRegistry):
+	''' asyncio based HTTP and Websocket server
+
+	Serves the files of web_dir and hands websocket connections to the registered modules,
+	same as webserver.ThreadedHTTPServer
+	'''
+
+	writer_stop_timeout = 2.0  # secs to wait for the writer to flush the last frames at close
+
+	def __init__(self, server_address, web_dir, credentials='', ssl_context=None,
+				 max_message_size=defaults.WS_MAX_MESSAGE_SIZE, send_queue_size=defaults.WS_SEND_QUEUE_SIZE,
+				 workers=defaults.WS_HANDLER_WORKERS):
+		'''
+		Args:
+		server_address (:obj:`tuple`): host and port to bind to
+		web_dir (:obj:`str`): directory of the static files
+		credentials (:obj:`str`): "user:password" for basic authentication, empty for none
+		ssl_context (:obj:`ssl.SSLContext`): for https and wss, None for plain http
+		max_message_size (:obj:`int`): maximal size of an incoming websocket message
+		send_queue_size (:obj:`int`): messages waiting for a slow client, more close the connection
+		workers (:obj:`int`): threads to run the module handlers
+		'''
+
+		self.server_address = server_address
+		self.web_dir = os.path.abspath(web_dir)
+		self.auth = b64encode(credentials.encode("ascii")).decode("ascii") if credentials else None
+		self.ssl_context = ssl_context
+		self.max_message_size = max_message_size
+		self.send_queue_size = send_queue_size
+		self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='websocket')
+		self.loop = None
+		self.server = None
+
+	def serve_forever(self):
+		''' runs the event loop of the server, returns after server_close()
+		'''
+
+		asyncio.run(self.serve())
+
+	async def serve(self):
+		self.loop = asyncio.get_running_loop()
+		host, port = self.server_address
+		self.server = await asyncio.start_server(
+			self.handle_client, host, port, ssl=self.ssl_context)
+		self.server_address = self.server.sockets[0].getsockname()[:2]
+		try:
+			await self.server.serve_forever()
+		except asyncio.CancelledError:
+			pass
+
+	def server_close(self):
+		''' stops the server, can be called from any thread
+		'''
+
+		if self.loop and self.server:
+			self.loop.call_soon_threadsafe(self.server.close)
+
+	async def handle_client(self, reader, writer):
+		''' handles a single HTTP request, which might become a websocket connection
+		'''
+
+		try:
+			try:
+				request = await reader.readuntil(b'\r\n\r\n')
+			except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+				return
+			lines = request.decode('iso-8859-1').split('\r\n')
+			try:
+				method, target, version = lines[0].split()
+			except ValueError:
+				await self.send_response(writer, 400)
+				return
+			headers = {}
+			for line in lines[1:]:
+				if ':' in line:
+					name, value = line.split(':', 1)
+					headers[name.strip().lower()] = value.strip()
+			if self.auth and headers.get('authorization') != "Basic %s" % self.auth:
+				await self.send_response(writer, 401, headers={'WWW-Authenticate': 'Basic realm="Plugwise"'})
+				return
+			if method == 'GET' and headers.get('upgrade', '').lower() == 'websocket':
+				await self.handshake(writer, headers)
+				await AsyncWebSocketConnection(self, reader, writer).run()
+			elif method in ('GET', 'HEAD'):
+				await self.send_file(writer, target, method == 'HEAD')
+			else:
+				await self.send_response(writer, 501)
+		except (ConnectionError, OSError):
+			pass
+		finally:
+			writer.close()
+
+	async def handshake(self, writer, headers):
+		key = headers.get('sec-websocket-key', '')
+		digest = b64encode(sha1((key + WS_GUID).encode('ascii')).digest()).decode()
+		writer.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+					  'Sec-WebSocket-Accept: %s\r\n\r\n' % digest).encode('ascii'))
+		await writer.drain()
+
+	async def send_response(self, writer, code, body=b'', headers=None, head_only=False):
+		lines = ['HTTP/1.0 %d %s' % (code, HTTP_REASONS[code]),
+				 'Date: %s' % email.utils.formatdate(usegmt=True),
+				 'Connection: close',
+				 'Content-Length: %d' % len(body)]
+		lines += ['%s: %s' % header for header in (headers or {}).items()]
+		writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1'))
+		if not head_only:
+			writer.write(body)
+		await writer.drain()
+
+	async def send_file(self, writer, target, head_only):
+		''' sends a file out of web_dir, like SimpleHTTPRequestHandler does
+		'''
+
+		path = posixpath.normpath(urllib.parse.unquote(urllib.parse.urlsplit(target).path))
+		file_name = os.path.join(self.web_dir, *[part for part in path.split('/') if part and part != '..'])
+		if os.path.isdir(file_name):
+			file_name = os.path.join(file_name, 'index.html')
+		try:
+			body = await self.loop.run_in_executor(self.executor, read_file, file_name)
+		except OSError:
+			await self.send_response(writer, 404, head_only=head_only)
+			return
+		content_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+		await self.send_response(writer, 200, body, {'Content-type': content_type}, head_only)
+
+
+def read_file(file_name):
+	with open(file_name, 'rb') as file:
+		return file.read()
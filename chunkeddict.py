@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections.abc import MutableMapping, ItemsView, ValuesView
+
+
+class ChunkedDict(MutableMapping):
+	''' dict like map, of which cheap read only snapshots can be taken while it's changed further on
+
+	The entries are spread by their hash over about sqrt(size) chunks. A snapshot shares all chunks with
+	the map, and the map copies a chunk only before its first change after a snapshot (copy on write).
+	So taking a snapshot and changing a single entry both cost about sqrt(size) instead of a copy of the whole map
+	'''
+
+	def __init__(self, data=None):
+		'''
+		Args:
+		data (:obj:`obj`): optional dict or mapping to start with
+		'''
+
+		self.chunks = [{}]
+		self.owned = [True]  # per chunk: not shared with a snapshot, so it can be changed in place
+		self.length = 0
+		self.frozen = False  # snapshots are read only
+		self.last_snapshot = None  # the snapshot of the actual content, if already taken
+		if data:
+			self.chunks = [dict(data.items())]
+			self.length = len(self.chunks[0])
+			chunk_count = 1
+			while self.length > 4 * chunk_count ** 2:
+				chunk_count *= 2
+			if chunk_count > 1:
+				self.rechunk(chunk_count)
+
+	def writable_chunk(self, key):
+		''' returns the chunk of key to be changed, copied before if it's shared with a snapshot
+		'''
+
+		if self.frozen:
+			raise TypeError("snapshots of a ChunkedDict are read only")
+		self.last_snapshot = None
+		index = hash(key) % len(self.chunks)
+		if not self.owned[index]:
+			self.chunks[index] = dict(self.chunks[index])
+			self.owned[index] = True
+		return self.chunks[index]
+
+	def rechunk(self, chunk_count):
+		''' spreads the entries over a new set of chunk_count chunks
+		'''
+
+		chunks = [{} for index in range(chunk_count)]
+		for chunk in self.chunks:
+			for key, value in chunk.items():
+				chunks[hash(key) % chunk_count][key] = value
+		self.chunks = chunks
+		self.owned = [True] * chunk_count
+
+	def snapshot(self):
+		''' returns a read only copy of the actual content, which shares the chunks with this map
+		'''
+
+		if self.frozen:
+			return self
+		if self.last_snapshot is None:
+			snapshot = ChunkedDict.__new__(ChunkedDict)
+			snapshot.chunks = list(self.chunks)
+			snapshot.owned = [False] * len(self.chunks)
+			snapshot.length = self.length
+			snapshot.frozen = True
+			snapshot.last_snapshot = None
+			self.owned = [False] * len(self.chunks)
+			self.last_snapshot = snapshot
+		return self.last_snapshot
+
+	def __getitem__(self, key):
+		return self.chunks[hash(key) % len(self.chunks)][key]
+
+	def __setitem__(self, key, value):
+		chunk = self.writable_chunk(key)
+		if not key in chunk:
+			self.length += 1
+		chunk[key] = value
+		# keep the chunks about as many as entries in each of them
+		if self.length > 4 * len(self.chunks) ** 2:
+			self.rechunk(2 * len(self.chunks))
+
+	def __delitem__(self, key):
+		del self.writable_chunk(key)[key]
+		self.length -= 1
+
+	def __contains__(self, key):
+		return key in self.chunks[hash(key) % len(self.chunks)]
+
+	def get(self, key, default=None):
+		return self.chunks[hash(key) % len(self.chunks)].get(key, default)
+
+	def __iter__(self):
+		for chunk in self.chunks:
+			yield from chunk
+
+	def __len__(self):
+		return self.length
+
+	def items(self):
+		return ChunkedItemsView(self)
+
+	def values(self):
+		return ChunkedValuesView(self)
+
+	def __repr__(self):
+		return 'ChunkedDict({0})'.format(dict(self.items()))
+
+
+class ChunkedItemsView(ItemsView):
+
+	def __iter__(self):
+		for chunk in self._mapping.chunks:
+			yield from chunk.items()
+
+
+class ChunkedValuesView(ValuesView):
+
+	def __iter__(self):
+		for chunk in self._mapping.chunks:
+			yield from chunk.values()
@@ -10,5 +10,21 @@ FORECAST_DAYS = 7  # how many days are in the time table
 TIME_TABLE_SIZE = 1
 TIME_TO_LIVE = 5  # how often a key can be lend further forward
 SMART_HOME_TIMEOUT = 2.0  # secs to wait for an answer from smart home interface
+MAX_OTP_TOKENS = 10000  # how many one time passwords can be valid at the same time
+OTP_CREATE_ATTEMPTS = 20  # how often to try to find an unused one time password
+MAX_VERIFIED_SERVICE_TOKENS = 1000  # how many verified service tokens to remember until they expire
+ACCESS_MANAGER_WORKERS = 4  # worker threads to keep the access manager load out of the messenger event loop
+ID_CARD_WORKERS = 2  # worker threads to sign and render id cards, 0 does it inside the event loop
+ID_CARD_QUEUE_SIZE = 20  # how many id card requests can be running or waiting, further requests are refused
 CONFIG_FILE = 'config/config.json'
 USER_DATA_FILE = 'config/users.json'
+USER_JOURNAL_FILE = 'config/users.journal'  # changes made since users.json was written
+JOURNAL_COMPACT_RECORDS = 1000  # rewrite users.json after that many journal records
+JOURNAL_RETRY_DELAY = 1.0  # secs to wait before a failed journal write is tried again
+STORAGE_BACKEND = 'json'  # 'json' for config.json/users.json, 'sqlite' for SQLITE_FILE
+SQLITE_FILE = 'config/zuul.db'  # filled out of the json files at the first start
+WS_MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # bytes, bigger websocket messages close the connection
+WS_SEND_QUEUE_SIZE = 256  # messages waiting for a slow websocket client, more close the connection
+WS_SERVER_BACKEND = 'thread'  # 'thread' for a thread per connection, 'asyncio' for one event loop for all
+WS_HANDLER_WORKERS = 8  # threads to run the module handlers of the asyncio server backend
+CONFIG_WRITE_DELAY = 1.0  # secs to collect config changes before writing them together
@@ -2,10 +2,134 @@
 # -*- coding: utf-8 -*-
 
 from ecdsa import SigningKey, VerifyingKey, BadSignatureError
+from ecdsa.ellipticcurve import PointJacobi
 from base64 import b64encode, b64decode
 import hashlib
 import datetime
+import struct
+import threading
 from storage import Storage
+import zuullogger
+
+try:  # cryptography is optional, without it all keys are made with ecdsa
+	from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+	from cryptography.hazmat.primitives import serialization
+	from cryptography.exceptions import InvalidSignature
+except ImportError:
+	Ed25519PrivateKey = None
+
+logger = zuullogger.getLogger(__name__)
+
+
+class EcdsaSignature:
+	''' the original key format: NIST192p keys of the pure python ecdsa library, signed with SHA-1
+
+	Wallet entries without 'alg' use this format
+	'''
+
+	alg = 'ecdsa'
+
+	def generate(self):
+		''' creates a new key pair
+
+		Return:
+		private key, public key (:obj:`str`): base64 encoded DER data
+		'''
+
+		sk = SigningKey.generate()
+		return b64encode(sk.to_der()).decode('ascii'), b64encode(sk.verifying_key.to_der()).decode('ascii')
+
+	def load_private(self, data):
+		return SigningKey.from_der(b64decode(data))
+
+	def load_public(self, data):
+		vk = VerifyingKey.from_der(b64decode(data))
+		# a point which knows the curve order gets precomputed multiplication tables,
+		# which makes each verification about twice as fast. VerifyingKey.precompute() can't do that
+		# for keys loaded out of DER data, as their point is missing the order
+		point = vk.pubkey.point
+		return VerifyingKey.from_public_point(
+			PointJacobi(vk.curve.curve, point.x(), point.y(),
+						1, vk.curve.order, generator=True),
+			curve=vk.curve, hashfunc=vk.default_hashfunc)
+
+	def sign(self, private_key, message):
+		return private_key.sign(message)
+
+	def verify(self, public_key, signature, message):
+		try:
+			return public_key.verify(signature, message)
+		except BadSignatureError:
+			return False
+
+
+class Ed25519Signature:
+	''' Ed25519 keys of the cryptography library, which signs and verifies much faster
+	'''
+
+	alg = 'ed25519'
+
+	def generate(self):
+		''' creates a new key pair
+
+		Return:
+		private key, public key (:obj:`str`): base64 encoded raw key bytes
+		'''
+
+		sk = Ed25519PrivateKey.generate()
+		private_bytes = sk.private_bytes(serialization.Encoding.Raw,
+										 serialization.PrivateFormat.Raw, serialization.NoEncryption())
+		public_bytes = sk.public_key().public_bytes(
+			serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+		return b64encode(private_bytes).decode('ascii'), b64encode(public_bytes).decode('ascii')
+
+	def load_private(self, data):
+		return Ed25519PrivateKey.from_private_bytes(b64decode(data))
+
+	def load_public(self, data):
+		return Ed25519PublicKey.from_public_bytes(b64decode(data))
+
+	def sign(self, private_key, message):
+		return private_key.sign(message)
+
+	def verify(self, public_key, signature, message):
+		try:
+			public_key.verify(signature, message)
+			return True
+		except InvalidSignature:
+			return False
+
+
+# all usable signature algorithms by their wallet 'alg' name
+signature_backends = {EcdsaSignature.alg: EcdsaSignature()}
+if Ed25519PrivateKey:
+	signature_backends[Ed25519Signature.alg] = Ed25519Signature()
+# the algorithm for new own keys
+default_alg = Ed25519Signature.alg if Ed25519PrivateKey else EcdsaSignature.alg
+
+
+def signature_backend(key):
+	''' returns the signature backend of a wallet entry
+
+	Args:
+	key (:obj:`dict`): the wallet entry
+	'''
+
+	alg = key.get('alg', EcdsaSignature.alg)
+	if not alg in signature_backends:
+		raise ValueError("signature algorithm {0} not available".format(alg))
+	return signature_backends[alg]
+
+# the v2 id cards are base45 encoded binary data, so the QR code can use the compact alphanumeric mode
+ID_CARD_V2_PREFIX = 'ZM:'
+ID_CARD_V2_HEADER = struct.Struct('>B5s5s5sI')  # version, requestor, receiver, authority, timestamp
+BASE45_CHARS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:'
+BASE45_VALUES = {char: value for value, char in enumerate(BASE45_CHARS)}
+
+# parsed key objects by (wallet id, key part, key material), see cached_key()
+key_cache = {}
+key_cache_wallet_version = None  # the config version of the wallet the cache belongs to
+key_cache_lock = threading.Lock()
 
 
 def hash(my_bytes, length=10):
@@ -36,6 +160,57 @@ def base642int(encoded):
 	return int.from_bytes(decoded, byteorder="big")
 
 
+def base45_encode(data):
+	''' encodes bytes into the QR alphanumeric character set as described in RFC 9285
+
+	Args:
+	data (:obj:`bytes`): the data to encode
+
+	Return:
+	encoded (:obj:`str`): 3 chars for each 2 bytes
+	'''
+
+	chars = []
+	for pos in range(0, len(data) - 1, 2):
+		number = data[pos] * 256 + data[pos + 1]
+		chars += [BASE45_CHARS[number % 45], BASE45_CHARS[number // 45 % 45], BASE45_CHARS[number // 2025]]
+	if len(data) % 2:
+		chars += [BASE45_CHARS[data[-1] % 45], BASE45_CHARS[data[-1] // 45]]
+	return ''.join(chars)
+
+
+def base45_decode(text):
+	''' decodes a base45_encode() string
+
+	Args:
+	text (:obj:`str`): the encoded data
+
+	Return:
+	data (:obj:`bytes`): the decoded data, raises ValueError on invalid data
+	'''
+
+	if len(text) % 3 == 1:
+		raise ValueError('invalid base45 length')
+	try:
+		values = [BASE45_VALUES[char] for char in text]
+	except KeyError:
+		raise ValueError('invalid base45 character')
+	data = bytearray()
+	for pos in range(0, len(values), 3):
+		group = values[pos:pos + 3]
+		if len(group) == 3:
+			number = group[0] + group[1] * 45 + group[2] * 2025
+			if number > 0xFFFF:
+				raise ValueError('invalid base45 data')
+			data += number.to_bytes(2, 'big')
+		else:
+			number = group[0] + group[1] * 45
+			if number > 0xFF:
+				raise ValueError('invalid base45 data')
+			data.append(number)
+	return bytes(data)
+
+
 def load_keys(store, name):
 	''' loads key data from store identified by name (=certificate owner name string hash)
 
@@ -49,17 +224,17 @@ def load_keys(store, name):
 			key (:obj:`obj`): own key pair
 	'''
 
-	# Create a NIST192p keypair
+	# Create a keypair with the best available algorithm
 	own_key = {}
 	id_hash = hash(name.encode())
 	wallet = store.read_config_value('wallet')
 	if not wallet:
 		wallet = {}
 	if not id_hash in wallet:  # do we not have our own key pair generated yet? Do it now
-		sk = SigningKey.generate()
-		own_key['private'] = b64encode(sk.to_der()).decode('ascii')
-		vk = sk.verifying_key
-		own_key['public'] = b64encode(vk.to_der()).decode('ascii')
+		# the config still holds the read wallet until the new one is written, so don't change it in place
+		wallet = dict(wallet)
+		own_key['private'], own_key['public'] = signature_backends[default_alg].generate()
+		own_key['alg'] = default_alg
 		own_key['name'] = name
 		own_key['id'] = id_hash
 		wallet[id_hash] = own_key
@@ -69,8 +244,41 @@ def load_keys(store, name):
 	return wallet, own_key
 
 
+def cached_key(store, key, part):
+	''' returns the parsed key object of a wallet entry
+
+	Parsing the DER data is expensive, so the key objects are kept in a cache, which is
+	cleared each time the wallet is written into the config
+
+	Args:
+	store (:obj:`obj`): storage handler
+	key (:obj:`dict`): the wallet entry
+	part (:obj:`str`): 'private' for the signing key, 'public' for the verifying key
+
+	Return:
+	key object of the signature backend
+	'''
+
+	global key_cache_wallet_version
+	wallet_version = store.config_version('wallet')
+	cache_key = (key['id'], part, key.get('alg'), key[part])
+	with key_cache_lock:
+		if wallet_version != key_cache_wallet_version:
+			key_cache.clear()
+			key_cache_wallet_version = wallet_version
+		key_object = key_cache.get(cache_key)
+	if key_object is None:
+		if part == 'private':
+			key_object = signature_backend(key).load_private(key[part])
+		else:
+			key_object = signature_backend(key).load_public(key[part])
+		with key_cache_lock:
+			key_cache[cache_key] = key_object
+	return key_object
+
+
 def sign_bytes(message, store, name):
-	''''sign a message (using SHA-1)
+	''''sign a message with the algorithm of the own key
 
 			Args:
 			message (:obj:`bytes`): data to sign
@@ -81,35 +289,56 @@ def sign_bytes(message, store, name):
 			signature (:obj:`string`): string representation of signature
 	'''
 
-	wallet, own_key = load_keys(store, name)
-	sk = SigningKey.from_der(b64decode(own_key['private']))
-	sig = sk.sign(message)
-	signature = b64encode(sig).decode('ascii')
+	signature = b64encode(sign_raw(message, store, name)).decode('ascii')
 	return signature
 
 
-def verify_sign(message, signature, key):
-	''''Load the verifying key, message, and signature and verify the signature (assume SHA-1 hash)
+def sign_raw(message, store, name):
+	''''sign a message like sign_bytes(), but returns the signature as bytes
+
+			Args:
+			message (:obj:`bytes`): data to sign
+			store (:obj:`obj`): storage handler
+			name (:obj:`string`):certificate owner name string hash
+
+			Return:
+			signature (:obj:`bytes`): the signature
+	'''
+
+	wallet, own_key = load_keys(store, name)
+	sk = cached_key(store, own_key, 'private')
+	return signature_backend(own_key).sign(sk, message)
+
+
+def verify_sign(message, signature, key, store=None):
+	''''Load the verifying key, message, and signature and verify the signature with the algorithm of the key
 
 			Args:
 					message (:obj:`bytes`):  signed data
-					signature (:obj:`string`): string representation of signature
+					signature (:obj:`string`): string representation of signature, or the raw signature bytes
 					key (:obj:`obj`):certificate owner name string hash
+					store (:obj:`obj`): optional storage handler to use the key cache
 
 			Return:
 					signature (:obj:`string`): string representation of signature
 	'''
 
-	# Load the verifying key, message, and signature and verify the signature (assume SHA-1 hash):
+	# Load the verifying key, message, and signature and verify the signature:
 
-	vk = VerifyingKey.from_der(b64decode(key['public']))
-	sig = b64decode(signature)
 	try:
-		vk.verify(sig, message)
+		backend = signature_backend(key)
+		if store:
+			vk = cached_key(store, key, 'public')
+		else:
+			vk = backend.load_public(key['public'])
+	except ValueError as ex:  # e.g. an Ed25519 certificate, but cryptography is not installed
+		logger.warning("can't verify signature: {0}".format(ex))
+		return False
+	sig = signature if isinstance(signature, bytes) else b64decode(signature)
+	if backend.verify(vk, sig, message):
 		print("good signature")
 		return True
-	except BadSignatureError:
-		print("BAD SIGNATURE")
+	print("BAD SIGNATURE")
 	return False
 
 
@@ -140,27 +369,85 @@ def verify_message(msg, modreq):
 			result (:obj:`bool`): True if signature is valid and fits to message
 	'''
 
+	return message_lifetime(msg, modreq) is not None
+
+
+def token_lifetime(token, modreq):
+	''' verify a service token in any of the formats made by get_id_card_string() or get_id_card_string_v2()
+
+	Args:
+			token (:obj:`str`): the token including its 'zm:' or 'ZM:' prefix
+
+			Return:
+			lifetime (:obj:`int`): seconds until the token gets too old, None if the token is not valid
+	'''
+
+	if token.startswith(ID_CARD_V2_PREFIX):
+		try:
+			data = base45_decode(token[len(ID_CARD_V2_PREFIX):])
+			version, requestor, receiver, authority_id, timestamp = ID_CARD_V2_HEADER.unpack_from(data)
+		except (ValueError, struct.error) as ex:
+			logger.warning("illegal token format: {0}".format(ex))
+			return None
+		if version != 2:
+			logger.warning("illegal token format: version {0}".format(version))
+			return None
+		header_size = ID_CARD_V2_HEADER.size
+		return check_token(receiver.hex(), authority_id.hex(), timestamp,
+						   data[:header_size], data[header_size:], modreq)
+	return message_lifetime(token.split(':')[1:], modreq)
+
+
+def message_lifetime(msg, modreq):
+	''' verify received content like verify_message(), but returns how long it stays valid
+
+	Args:
+			msg (:obj:`list`): the token parts, see verify_message()
+
+			Return:
+			lifetime (:obj:`int`): seconds until the token gets too old, None if the token is not valid
+	'''
+
 	if len(msg) < 5:
 		print('illegal token format')
-		return False
-	receiver = modreq.messenger.messenger.myself()['username']
-	if msg[1] != hash(receiver.encode()):  # wrong receipient :-)
-		return False
-	authority_id = msg[2]
+		return None
+	return check_token(msg[1], msg[2], base642int(msg[3]), ":".join(msg[:4]).encode(), msg[4], modreq)
+
+
+def check_token(receiver_hash, authority_id, timestamp, message, signature, modreq):
+	''' checks the fields of a service token
+
+	Args:
+			receiver_hash (:obj:`str`): 10 char hex SHA1 hash of id of receiver
+			authority_id (:obj:`str`): 10 char hex SHA1 hash of id of signed authority
+			timestamp (:obj:`int`): Unix UTC seconds when the token was made
+			message (:obj:`bytes`): the signed part of the token
+			signature (:obj:`obj`): base64 string or raw bytes of the signature
+
+			Return:
+			lifetime (:obj:`int`): seconds until the token gets too old, None if the token is not valid
+	'''
+
+	# the messenger plugin resolves its own identity once at start, so no network access is needed here
+	messenger = getattr(modreq.messenger, 'messenger', None)
+	if not messenger or not messenger.receiver_hash:  # messenger not started yet
+		return None
+	if receiver_hash != messenger.receiver_hash:  # wrong receipient :-)
+		return None
 	wallet = modreq.store.read_config_value('wallet')
 	if not wallet or not authority_id in wallet:  # unknown authority
-		return False
+		return None
 	this_key = wallet[authority_id]
-	timestamp = base642int(msg[3])
 	try:
 		timeout = this_key['timeout']
 	except:
 		timeout = 60  # default token lifetime 60 secs
-	if unix_time()-timeout > timestamp:  # token too old
-		return False
-	message = ":".join(msg[:4])
-	signature = msg[4]
-	return verify_sign(message.encode(), signature, this_key)
+	lifetime = timestamp + timeout - unix_time()
+	if lifetime < 0:  # token too old
+		return None
+	if not verify_sign(message, signature, this_key, modreq.store):
+		return None
+	return lifetime
 
 
 def get_id_card_string(store, requestor, receiver, botname):
@@ -191,6 +478,28 @@ def get_id_card_string(store, requestor, receiver, botname):
 	return ":".join([message, signature])
 
 
+def get_id_card_string_v2(store, requestor, receiver, botname):
+	''' makes the same id card as get_id_card_string(), but packed as binary data and base45 encoded
+
+	Args:
+			store (:obj:`obj`): storage handler
+			requestor (:obj:`string`): id of the requesting user
+			receiver (:obj:`string`) :name of receiving bot
+			botname (:obj:`string`): name of the own bot
+
+	Return:
+			message (:obj:`string`): base45 encoded bytes of
+					version (1 byte): 2
+					requestor, receiver, authority (5 bytes each): the SHA1 hashes as in get_id_card_string()
+					timestamp (4 bytes): Unix UTC seconds
+					signature: signature of all bytes before
+	'''
+
+	header = ID_CARD_V2_HEADER.pack(2, bytes.fromhex(hash(requestor.encode())), bytes.fromhex(hash(
+		receiver.encode())), bytes.fromhex(hash(botname.encode())), unix_time())
+	return base45_encode(header + sign_raw(header, store, botname))
+
+
 if __name__ == '__main__':
 	#key = create_keys()
 	message = "message".encode()
@@ -205,6 +514,59 @@ if __name__ == '__main__':
 	number2 = base642int(number_string)
 	print(number == number2)
 
+	# compares the signature algorithms
+	import time
+	print('{0:10} {1:>12} {2:>14} {3:>16}'.format(
+		'alg', 'signs/sec', 'verifies/sec', 'signature chars'))
+	for alg, backend in signature_backends.items():
+		private_data, public_data = backend.generate()
+		private_key = backend.load_private(private_data)
+		public_key = backend.load_public(public_data)
+		rounds = 200
+		start = time.perf_counter()
+		for i in range(rounds):
+			sig = backend.sign(private_key, message)
+		sign_time = time.perf_counter() - start
+		start = time.perf_counter()
+		for i in range(rounds):
+			backend.verify(public_key, sig, message)
+		verify_time = time.perf_counter() - start
+		print('{0:10} {1:>12.0f} {2:>14.0f} {3:>16}'.format(
+			alg, rounds / sign_time, rounds / verify_time, len(b64encode(sig))))
+
+	# compares the token formats, the QR version is only shown if the qrcode module is installed
+	try:
+		import qrcode
+	except ImportError:
+		qrcode = None
+	data = base45_decode(base45_encode(b'\x00\xff' * 10 + b'\x07'))
+	print(data == b'\x00\xff' * 10 + b'\x07')
+	print('{0:10} {1:>8} {2:>12} {3:>12}'.format('format', 'chars', 'QR version', 'parse (us)'))
+	for alg, backend in signature_backends.items():
+		sig = backend.sign(backend.load_private(backend.generate()[0]), message)
+		header = ID_CARD_V2_HEADER.pack(2, bytes(5), bytes(5), bytes(5), unix_time())
+		v1_token = 'zm:' + ':'.join([hash(b'a'), hash(b'b'), hash(b'c'), time_base64(),
+									b64encode(sig).decode('ascii')])
+		v2_token = ID_CARD_V2_PREFIX + base45_encode(header + sig)
+		for name, token in (('v1 ' + alg, v1_token), ('v2 ' + alg, v2_token)):
+			rounds = 10000
+			start = time.perf_counter()
+			for i in range(rounds):
+				if token.startswith(ID_CARD_V2_PREFIX):
+					ID_CARD_V2_HEADER.unpack_from(base45_decode(token[3:]))
+				else:
+					parts = token.split(':')
+					base642int(parts[4]), b64decode(parts[5])
+			parse_time = time.perf_counter() - start
+			version = '-'
+			if qrcode:
+				qr = qrcode.QRCode()
+				qr.add_data(token)
+				qr.make(fit=True)
+				version = qr.version
+			print('{0:10} {1:>8} {2:>12} {3:>12.1f}'.format(
+				name, len(token), version, parse_time / rounds * 1e6))
+
 # >>> hash = hashlib.sha1("my message".encode("UTF-8")).hexdigest()
 # >>> hash
 # '104ab42f1193c336aa2cf08a2c946d5c6fd0fcdb'
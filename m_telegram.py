@@ -11,6 +11,7 @@ import string
 import secrets
 import asyncio
 import zuullogger
+import idcard
 from user import User
 from io import BytesIO
 import urllib
@@ -20,6 +21,32 @@ import translate
 logger = zuullogger.getLogger(__name__)
 
 
+def render_qrcode(data):
+	''' renders a QR code as PNG image
+
+	Args:
+	data (:obj:`str`): the QR code content
+
+	Return:
+	BytesIO object containing the PNG image
+	'''
+
+	qr = qrcode.QRCode(
+		version=1,
+		error_correction=qrcode.constants.ERROR_CORRECT_L,
+		box_size=10,
+		border=4,
+	)
+	qr.add_data(data)
+	qr.make(fit=True)
+	img = qr.make_image(fill_color="black", back_color="white",image_factory=PyPNGImage)
+	bio = BytesIO()
+	bio.name = 'image.png'
+	img.save(bio, 'PNG')
+	bio.seek(0)
+	return bio
+
+
 class UserContext:
 	''' object to hold all user relevant data of an incoming message.
 			python-telegram-bot itself handles all incoming events in a global context,
@@ -143,6 +170,10 @@ class ZuulMessengerPlugin:
 		self.application = ApplicationBuilder().token(messenger_token).build()
 
 		self.access_manager = access_manager
+		# the bot user itself, resolved once at start by refresh_identity()
+		self.identity = None
+		# idcard.hash() of the bot username, as used as receiver in the id cards
+		self.receiver_hash = None
 
 		# on different commands - answer in Telegram
 		# will be automatically called at new connection
@@ -187,6 +218,7 @@ class ZuulMessengerPlugin:
 		
 		async with self.application:
 			await self.application.initialize() # inits bot, update, persistence
+			await self.refresh_identity()
 			await self.application.start()
 			await self.application.updater.start_polling()
 			await self.application.idle()
@@ -202,11 +234,19 @@ class ZuulMessengerPlugin:
 		return User(chat_user.first_name, chat_user.last_name, chat_user.id, chat_user.
 					language_code)
 
+	async def refresh_identity(self):
+		'''asks telegram once about the bot itself and keeps the answer
+		'''
+		self.identity = await self.application.bot.get_me()
+		self.receiver_hash = idcard.hash(self.identity.username.encode())
+		logger.info('running as bot {0}'.format(self.identity.username))
+
 	async def myself(self) -> User :
 		'''returns a user object about the bot itself
 		'''
-		user = await self.application.bot.get_me()
-		return user
+		if not self.identity:  # not started yet
+			await self.refresh_identity()
+		return self.identity
 
 	async def send_pin_code(self, update, context, query):
 		''' requests OneTimePassword (OTP) from access_manager and
@@ -214,24 +254,10 @@ class ZuulMessengerPlugin:
 		'''
 
 		user_context = UserContext.get_user_context(update, context, query)
-		otp = self.access_manager.requestOTP(user_context.user)
+		otp = await self.access_manager.requestOTP_async(user_context.user)
 		if otp['valid_time'] > 0:
 			if otp['type'] == 'qrcode':
-				qr = qrcode.QRCode(
-					version=1,
-					error_correction=qrcode.constants.ERROR_CORRECT_L,
-					box_size=10,
-					border=4,
-				)
-				qr.add_data(otp['otp'])
-				qr.make(fit=True)
-
-				img = qr.make_image(fill_color="black", back_color="white",image_factory=PyPNGImage)
-
-				bio = BytesIO()
-				bio.name = 'image.png'
-				img.save(bio, 'PNG')
-				bio.seek(0)
+				bio = render_qrcode(otp['otp'])
 				if otp['msg']:
 					msg_text = otp['msg']
 				else:
@@ -273,7 +299,7 @@ class ZuulMessengerPlugin:
 				user_context.user) != None:
 				  # in case the /start command contains another bot name to make a certificate QRCode for it
 			if context.args:
-				self.create_certificate(
+				await self.create_certificate(
 					user_context, urllib.parse.unquote(context.args[0]))
 			else:
 				await self.send_pin_code(update, context, query)
@@ -295,21 +321,13 @@ class ZuulMessengerPlugin:
 	async def create_certificate(self, user_context, door_bot_name):
 		"""Send acertificate."""
 		own_bot_username = (await self.myself()).name
-		id_card = self.access_manager.request_id_card(
-			user_context.user, door_bot_name, own_bot_username)
-		qr = qrcode.QRCode(
-			version=1,
-			error_correction=qrcode.constants.ERROR_CORRECT_L,
-			box_size=10,
-			border=4,
-		)
-		qr.add_data(id_card)
-		qr.make(fit=True)
-		img = qr.make_image(fill_color="black", back_color="white",image_factory=PyPNGImage)
-		bio = BytesIO()
-		bio.name = 'image.png'
-		img.save(bio, 'PNG')
-		bio.seek(0)
+		# signing and rendering are cpu bound, so they are done outside of the event loop
+		bio = await self.access_manager.request_id_card_async(
+			user_context.user, door_bot_name, own_bot_username, render_qrcode)
+		if not bio:
+			await user_context.msg.reply_text(
+				user_context._('Too many requests just now. Please try again in a moment'))
+			return
 		msg_text = user_context._(
 			'Digital ID Card from {0}- Just present it to the door camera to open the door').format(own_bot_username)
 		await user_context.msg.reply_text(
@@ -320,7 +338,7 @@ class ZuulMessengerPlugin:
 		'''adds a new user'''
 		user_context = UserContext.get_user_context(update, context, query)
 		if user_context.new_contact and user_context.user:
-			changed_users = self.access_manager.add_user(  # add the contact as new follower
+			changed_users = await self.access_manager.add_user_async(  # add the contact as new follower
 				user_context.user, user_context.new_contact)
 			keyboard = [[InlineKeyboardButton(
 				'🚪'+(await self.myself()).first_name, callback_data='main')]]
@@ -344,7 +362,7 @@ class ZuulMessengerPlugin:
 		user_context = UserContext.get_user_context(update, context, query)
 		delete_user = self.access_manager.user_info_by_id(query.data)
 		if delete_user and user_context.user:
-			changed_users = self.access_manager.delete_user_by_id(
+			changed_users = await self.access_manager.delete_user_by_id_async(
 				self.access_manager.user_id(user_context.user), query.data)
 			for user in changed_users:  # sent a note to all users who have lost access now
 				try:
@@ -363,7 +381,7 @@ class ZuulMessengerPlugin:
 		user_context = UserContext.get_user_context(update, context, query)
 		delete_user = self.access_manager.user_info_by_id(query.data)
 		if delete_user and user_context.user:
-			changed_users = self.access_manager.delete_user_by_id(
+			changed_users = await self.access_manager.delete_user_by_id_async(
 				query.data, self.access_manager.user_id(user_context.user))
 			for user in changed_users:  # sent a note to all users who have lost access now
 				try:
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import sqlite3
+import threading
+
+import zuullogger
+import user
+import defaults
+from storage import Storage
+from timetable import TimeTable
+
+logger = zuullogger.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS config (
+	key TEXT PRIMARY KEY,
+	value TEXT NOT NULL -- JSON encoded
+);
+CREATE TABLE IF NOT EXISTS wallet (
+	id TEXT PRIMARY KEY,
+	name TEXT,
+	entry TEXT NOT NULL -- the whole JSON encoded wallet entry
+);
+CREATE TABLE IF NOT EXISTS users (
+	user_id TEXT PRIMARY KEY,
+	first_name TEXT,
+	last_name TEXT,
+	language TEXT,
+	time_table BLOB -- TimeTable.slots, NULL if the user has no access
+);
+CREATE INDEX IF NOT EXISTS users_with_access ON users (user_id) WHERE time_table IS NOT NULL;
+CREATE TABLE IF NOT EXISTS timetables (
+	sponsor_id TEXT NOT NULL,
+	time_table_id TEXT NOT NULL,
+	deletion_timestamp REAL,
+	PRIMARY KEY (sponsor_id, time_table_id)
+);
+CREATE TABLE IF NOT EXISTS edges (
+	sponsor_id TEXT NOT NULL,
+	time_table_id TEXT NOT NULL,
+	follower_id TEXT NOT NULL,
+	deletion_timestamp REAL, -- NULL as long as the follower has the key
+	PRIMARY KEY (sponsor_id, time_table_id, follower_id)
+);
+CREATE INDEX IF NOT EXISTS active_edges_by_follower ON edges (follower_id) WHERE deletion_timestamp IS NULL;
+CREATE TABLE IF NOT EXISTS meta (
+	key TEXT PRIMARY KEY,
+	value TEXT
+);
+'''
+
+
+class SqliteStorage(Storage):
+	''' storage backend which keeps all persistent data in a SQLite database
+
+	The key lendings are stored as single rows (edges) instead of nested dicts, so
+	only the lendings without deletion date and the users who can be reached by them
+	need to be loaded into memory. The history of returned keys stays in the database.
+
+	On the first start the data are migrated once out of config.json, users.json and the users.journal,
+	these files are not used anymore afterwards.
+
+	Tables:
+		config: key -> JSON value of all config values except the wallet
+		wallet: one row per wallet entry
+		users: one row per user, the time table as raw bytes
+		timetables: the time tables (actual always '1') of each sponsor
+		edges: sponsor -> follower key lendings
+		meta: the stamp of the users table
+	'''
+
+	def __init__(self, modref):
+		''' opens the database and loads all data
+		'''
+
+		self.db_file_name = os.path.join(
+			os.path.dirname(__file__), defaults.SQLITE_FILE)
+		# the connection is shared between the journal thread and the config write timer
+		self.db_lock = threading.Lock()
+		self.db = sqlite3.connect(self.db_file_name, check_same_thread=False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=FULL')
+		self.db.executescript(SCHEMA)
+		self.migrate = not self.db.execute('SELECT 1 FROM config LIMIT 1').fetchone()
+		Storage.__init__(self, modref)
+		self.compact_records = 0  # each write goes straight into the tables
+
+	def load_config(self):
+		''' loads the config out of the database, or out of config.json at the first start
+		'''
+
+		if self.migrate:
+			Storage.load_config(self)
+			self.dirty_config_keys = set(self.config)
+			self.flush_config()
+			return
+		self.config = {key: json.loads(value) for key, value in self.db.execute(
+			'SELECT key, value FROM config')}
+		wallet = {wallet_id: json.loads(entry) for wallet_id, entry in self.db.execute(
+			'SELECT id, entry FROM wallet')}
+		if wallet:
+			self.config['wallet'] = wallet
+
+	def load_users(self):
+		''' loads all users with access, all active key lendings and the users on both ends of them
+		out of the database, or out of users.json at the first start
+		'''
+
+		if self.migrate:
+			Storage.load_users(self)
+			self.write_journal_jobs([('users', 0, self.encode_users())])
+			logger.info("migrated {0} users into {1}".format(
+				len(self.users['users']), self.db_file_name))
+			return
+		self.users = {'users': {}, 'timetables': {}}
+		stamp = self.db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+		if stamp:
+			self.users['stamp'] = stamp[0]
+		for sponsor_id, time_table_id, follower_id, deletion_timestamp in self.db.execute(
+				'SELECT e.sponsor_id, e.time_table_id, e.follower_id, t.deletion_timestamp FROM edges e '
+				'JOIN timetables t USING (sponsor_id, time_table_id) WHERE e.deletion_timestamp IS NULL'):
+			time_tables = self.users['timetables'].setdefault(sponsor_id, {})
+			time_table = time_tables.setdefault(time_table_id, {
+				'users': {}, 'deletion_timestamp': deletion_timestamp})
+			time_table['users'][follower_id] = None
+		admins = self.get_admin_ids() or []
+		for user_id, first_name, last_name, language, time_table in self.db.execute(
+				'SELECT user_id, first_name, last_name, language, time_table FROM users '
+				'WHERE time_table IS NOT NULL OR user_id IN '
+				'(SELECT follower_id FROM edges WHERE deletion_timestamp IS NULL) OR user_id IN '
+				'(SELECT sponsor_id FROM edges WHERE deletion_timestamp IS NULL) OR user_id IN ({0})'.format(
+					','.join('?' * len(admins))), admins):
+			self.users['users'][user_id] = {
+				'user': user.User(first_name, last_name, user_id, language),
+				'time_table': TimeTable(time_table) if time_table is not None else None}
+
+	def encode_config(self, keys):
+		''' converts the changed config values into database rows
+
+		Args:
+		keys (:obj:`set`): the changed config keys
+
+		Return:
+		tuple of config rows, wallet rows or None if the wallet is unchanged
+		'''
+
+		config_rows = [(key, json.dumps(self.config[key]) if key in self.config else None)
+					   for key in keys if key != 'wallet']
+		wallet_rows = None
+		if 'wallet' in keys:
+			wallet_rows = [(wallet_id, entry.get('name'), json.dumps(entry))
+						   for wallet_id, entry in (self.config.get('wallet') or {}).items()]
+		return config_rows, wallet_rows
+
+	def write_config_data(self, rows):
+		''' writes the changed config values into the database
+
+		Args:
+		rows (:obj:`tuple`): made by encode_config()
+		'''
+
+		config_rows, wallet_rows = rows
+		with self.db_lock, self.db:
+			self.db.executemany('DELETE FROM config WHERE key = ?', [
+				(key,) for key, value in config_rows if value is None])
+			self.db.executemany('INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)', [
+				row for row in config_rows if row[1] is not None])
+			if wallet_rows is not None:
+				self.db.execute('DELETE FROM wallet')
+				self.db.executemany(
+					'INSERT INTO wallet (id, name, entry) VALUES (?, ?, ?)', wallet_rows)
+
+	def encode_users(self, snapshot=None):
+		''' converts the whole user data into database rows
+
+		Args:
+		snapshot (:obj:`UserSnapshot`): published user data to convert instead of the actual user data
+		'''
+
+		return self.encode_patch(self.snapshot_users(snapshot))
+
+	def encode_patch(self, patch):
+		''' converts a journal_users() patch into database rows
+
+		Return:
+		tuple of rows to delete, user rows, time table rows, edge rows, meta rows
+		'''
+
+		deleted_users = []
+		user_rows = []
+		for user_id, user_entry in patch.get('users', {}).items():
+			if user_entry is None:
+				deleted_users.append((user_id,))
+				continue
+			time_table = user_entry['time_table']
+			user_rows.append((user_id, user_entry['user'].get('first_name'), user_entry['user'].get('last_name'),
+							  user_entry['user'].get('language'), time_table.slots if time_table is not None else None))
+		time_table_rows = []
+		edge_rows = []
+		for sponsor_id, time_tables in patch.get('timetables', {}).items():
+			for time_table_id, time_table in (time_tables or {}).items():
+				time_table_rows.append(
+					(sponsor_id, time_table_id, time_table['deletion_timestamp']))
+				for follower_id, deletion_timestamp in time_table['users'].items():
+					edge_rows.append(
+						(sponsor_id, time_table_id, follower_id, deletion_timestamp))
+		# the single changed key lendings of a journal patch
+		for sponsor_id, time_table_id, follower_id, deletion_timestamp in patch.get('edges', []):
+			edge_rows.append((sponsor_id, time_table_id, follower_id, deletion_timestamp))
+		meta_rows = [('stamp', patch['stamp'])] if 'stamp' in patch else []
+		return deleted_users, user_rows, time_table_rows, edge_rows, meta_rows
+
+	def write_journal_jobs(self, jobs):
+		''' writes a group of journal jobs in one transaction
+
+		The edges are only inserted or updated, never deleted, as they are not all in memory.
+		For the same reason, a complete write of all users only removes the access of the users not in memory anymore
+
+		Args:
+		jobs (:obj:`list`): list of (job type, sequence number, rows), see queue_journal_job()
+		'''
+
+		with self.db_lock, self.db:
+			for job_type, sequence, (deleted_users, user_rows, time_table_rows, edge_rows, meta_rows) in jobs:
+				if job_type == 'users':
+					self.db.execute(
+						'UPDATE users SET time_table = NULL WHERE time_table IS NOT NULL')
+				self.db.executemany(
+					'DELETE FROM users WHERE user_id = ?', deleted_users)
+				self.db.executemany(
+					'INSERT OR REPLACE INTO users (user_id, first_name, last_name, language, time_table) '
+					'VALUES (?, ?, ?, ?, ?)', user_rows)
+				self.db.executemany(
+					'INSERT OR REPLACE INTO timetables (sponsor_id, time_table_id, deletion_timestamp) '
+					'VALUES (?, ?, ?)', time_table_rows)
+				# a key lending of a patch might be the first of a new time table
+				self.db.executemany(
+					'INSERT OR IGNORE INTO timetables (sponsor_id, time_table_id) VALUES (?, ?)',
+					[edge_row[:2] for edge_row in edge_rows])
+				self.db.executemany(
+					'INSERT OR REPLACE INTO edges (sponsor_id, time_table_id, follower_id, deletion_timestamp) '
+					'VALUES (?, ?, ?, ?)', edge_rows)
+				self.db.executemany(
+					'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', meta_rows)
+
+	def get_active_edges(self):
+		''' yields all key lendings without deletion date, as written so far
+
+		Return:
+		iterator of (sponsor_id, time_table_id, follower_id)
+		'''
+
+		with self.db_lock:
+			rows = self.db.execute(
+				'SELECT sponsor_id, time_table_id, follower_id FROM edges WHERE deletion_timestamp IS NULL').fetchall()
+		return iter(rows)
@@ -3,17 +3,33 @@
 
 import os
 import json
+import threading
+import time
 
 import zuullogger
 import translate
 import user
 import defaults
+from timetable import TimeTable, json_default
 
 _ = translate.gettext
 
 logger = zuullogger.getLogger(__name__)
 
 
+def create_storage(modref):
+	''' creates the storage backend selected by defaults.STORAGE_BACKEND
+
+	Args:
+	modref (:obj:`ModRef`): the global module references
+	'''
+
+	if defaults.STORAGE_BACKEND == 'sqlite':
+		import sqlitestorage  # imported here, as it's a subclass of Storage
+		return sqlitestorage.SqliteStorage(modref)
+	return Storage(modref)
+
+
 class Storage:
 	'''loads and saves all persistent data to disk
 
@@ -23,10 +39,19 @@ class Storage:
 The users.json contains the living data of the system, while config.json contains the more static data.
 The config.json can be manipulated through the web interface
 
+The users.json is not rewritten on each change. Instead each change is appended as one line to the users.journal,
+which contains the changed entries of the "users" and "timetables" tables. At startup the journal is replayed on top of users.json.
+After JOURNAL_COMPACT_RECORDS changes the users.json is rewritten and the journal starts again.
+
+Other storage backends (see sqlitestorage.SqliteStorage) derive from this class and replace
+load_config(), load_users(), encode_config(), write_config_data(), encode_users(), encode_patch(),
+write_journal_jobs() and get_active_edges()
+
 Format of users.json:
 .. code-block:: json
 
 	{
+			"stamp": "5f0c...:0e1a...", # identifies the config and key lendings the users table has been calculated with, see AccessManager.user_table_stamp()
 			"timetables": { # timetimes contains, which user (A) has lend the key to others (B)
 					"1137173018": { # id of user A
 							"1": { # unique ID of this this time table, actual always 1, as multiple time tables not implemented yet
@@ -61,14 +86,20 @@ Format of config.json:
 			"messenger_token": "the Bot API Token", 
 			"messenger_type": "telegram",
 			"server_config": { # address and port the http/websocket server binds to
+					"backend": "thread", # optional, "asyncio" handles all connections in one event loop instead of a thread each
 					"credentials": "",
 					"host": "0.0.0.0",
+					"max_message_size": 16777216, # optional, bytes, bigger websocket messages close the connection
 					"port": 8000,
-					"secure": false
+					"secure": false,
+					"send_queue_size": 256 # optional, messages waiting for a slow client, more close the connection
 			},
+			"id_card_format": 1, # optional, 2 makes compact base45 service tokens ("ZM:..") for smaller QR codes
+			"single_use_service_tokens": false, # optional, accept each service token only once
 			"timetolive": 5, # depth, how often the keys can be lend further forward
 			"wallet": { # the collection of own and imported certificates
 					"c4ab98b84c": { # the own certificate, the only one containing private key
+							"alg": "ed25519", # signature algorithm, see idcard.signature_backends. Missing for the older "ecdsa" keys
 							"id": "c4ab98b84c",
 							"name": "koehlersDoorBot",
 							"private": "private key",
@@ -94,6 +125,42 @@ Format of config.json:
 			os.path.dirname(__file__), defaults.CONFIG_FILE)
 		self.users_file_name = os.path.join(
 			os.path.dirname(__file__), defaults.USER_DATA_FILE)
+		self.journal_file_name = os.path.join(
+			os.path.dirname(__file__), defaults.USER_JOURNAL_FILE)
+		# the journal is written by a seperate thread to collect the records of parallel changes into one disk write
+		self.journal_condition = threading.Condition()
+		self.journal_jobs = []  # list of (job type, sequence number, data) to write
+		self.journal_sequence = 0  # sequence number of the last queued job
+		self.journal_written = 0  # sequence number of the last job which is safe on disk
+		self.journal_records = 0  # number of records in the journal since the last users.json write
+		self.journal_thread = None
+		self.journal_file = None  # the journal, opened by the journal thread
+		self.journal_length = None  # size of the journal up to the last synced record
+		# rewrite users.json after that many journal records, 0 for never
+		self.compact_records = defaults.JOURNAL_COMPACT_RECORDS
+		# config changes are only noted and written later together by a timer
+		self.config_lock = threading.Lock()
+		self.config_write_lock = threading.Lock()  # keeps the writes in order
+		self.dirty_config_keys = set()
+		self.config_versions = {}  # key -> number of writes, see config_version()
+		self.config_timer = None
+		# websocket users which get the changes of the user data as 'treedelta' messages
+		self.tree_lock = threading.Lock()
+		self.tree_subscribers = {}  # websocket user -> snapshot version of the tree the user got
+		self.tree_deltas = []  # (snapshot version, JSON encoded delta) to send after the journal thread has written them
+		self.tree_cache = (None, None)  # (snapshot version, JSON encoded user data)
+		self.startup_times = []  # list of (step, secs) for the startup report
+		start = time.perf_counter()
+		self.load_config()
+		self.startup_times.append(('load config', time.perf_counter() - start))
+		start = time.perf_counter()
+		self.load_users()
+		self.create_new_admins_if_any()
+		self.startup_times.append(('load users', time.perf_counter() - start))
+
+	def load_config(self):
+		''' loads the config from config.json
+		'''
 
 		try:
 			with open(self.config_file_name) as json_file:
@@ -119,14 +186,82 @@ Format of config.json:
 				}
 			}
 
+	def load_users(self):
+		''' loads the users from users.json and the journal
+		'''
+
 		try:
 			with open(self.users_file_name) as json_file:
 				self.users = json.load(json_file)
+			self.load_time_tables(self.users['users'])
 
 		except:
 			logger.warning("couldn't load users file {0}".format(
 				self.users_file_name))
-		self.create_new_admins_if_any()
+		self.replay_journal()
+
+	def load_time_tables(self, users):
+		''' converts the time tables of the users out of the JSON list format
+
+		Args:
+		users (:obj:`dict`): user_id -> user entry
+		'''
+
+		for user_entry in users.values():
+			if user_entry and user_entry['time_table'] is not None:
+				user_entry['time_table'] = TimeTable.from_list(
+					user_entry['time_table'])
+
+	def apply_users_patch(self, patch):
+		''' applies a journal record to the user data
+
+		Args:
+		patch (:obj:`dict`): 'users' and 'timetables' dicts with the changed entries, None for removed entries,
+				'edges' list of [sponsor_id, time_table_id, follower_id, deletion_timestamp] of the changed key lendings,
+				optional the new 'stamp'
+		'''
+
+		for table_name in ['users', 'timetables']:
+			for key, value in patch.get(table_name, {}).items():
+				if value is None:
+					self.users[table_name].pop(key, None)
+				else:
+					self.users[table_name][key] = value
+		for sponsor_id, time_table_id, follower_id, deletion_timestamp in patch.get('edges', []):
+			time_table = self.users['timetables'].setdefault(sponsor_id, {}).setdefault(
+				time_table_id, {'users': {}, 'deletion_timestamp': None})
+			time_table['users'][follower_id] = deletion_timestamp
+		if 'stamp' in patch:
+			self.users['stamp'] = patch['stamp']
+
+	def replay_journal(self):
+		''' applies the changes of the journal, which are not in users.json yet
+		'''
+
+		try:
+			with open(self.journal_file_name, 'rb+') as journal_file:
+				valid_length = 0
+				for line in journal_file:
+					try:
+						if not line.endswith(b'\n'):
+							raise ValueError('record not terminated')
+						patch = json.loads(line.decode('utf-8'))
+					except ValueError:
+						# the last record was not finished when the program stopped,
+						# so cut it off to not have the next records appended to it
+						logger.warning("ignoring incomplete record in {0}".format(
+							self.journal_file_name))
+						journal_file.truncate(valid_length)
+						break
+					self.load_time_tables(patch.get('users', {}))
+					self.apply_users_patch(patch)
+					self.journal_records += 1
+					valid_length += len(line)
+		except FileNotFoundError:
+			pass
+		except Exception as ex:
+			logger.warning("couldn't read journal file {0} because {1}".format(
+				self.journal_file_name, ex))
 
 	def create_new_admins_if_any(self):
 		# copy admin acounts into the user list, if not already in
@@ -139,15 +274,33 @@ Format of config.json:
 		''' helper routine to create a full packet time table for the admins
 
 		Return:
-		time_table dict
+		time_table (:obj:`TimeTable`)
+		'''
+
+		time_to_live = self.read_config_value('timetolive', defaults.TIME_TO_LIVE)
+		valid_time_to_live = self.valid_time_to_live(time_to_live)
+		if valid_time_to_live is None:
+			valid_time_to_live = defaults.TIME_TO_LIVE
+		if valid_time_to_live != time_to_live:
+			logger.warning("invalid timetolive {0}, using {1}".format(
+				repr(time_to_live), valid_time_to_live))
+		return TimeTable.full(valid_time_to_live)
+
+	def valid_time_to_live(self, value):
+		''' checks a timetolive config value
+
+		Args:
+		value (:obj:`obj`): the value as given by the config or the web UI
+
+		Return:
+		the value limited to 0..TimeTable.MAX_TTL, None if it's not a number at all
 		'''
 
-		res = []
-		ttl = self.read_config_value(
-			'timetolive', defaults.TIME_TO_LIVE)
-		for i in range(defaults.TIME_TABLE_SIZE):  # for each entry slot
-			res.append(ttl)
-		return res
+		try:
+			value = int(value)
+		except (TypeError, ValueError):
+			return None
+		return min(max(value, 0), TimeTable.MAX_TTL)
 
 	def config_keys(self):
 		'''provides config values allowed to change by the web interface
@@ -165,27 +318,107 @@ Format of config.json:
 		'''
 
 		if data['type'] == 'st_tree':
-			config = {}
-			for key in self.config_keys():
-				### if we have a password, then the token should not be changed through
-				# the UI because of the actual poor implementation of the password handling
-				if self.config['current_password'] and key=='messenger_token':
-					continue
+			# the access manager publishes consistent snapshots of the user data while it's changing them
+			ws_user.ws.emit_json("tree", self.tree_message(self.modref.accessmanager.snapshot))
+		if data['type'] == 'st_subscribe':
+			self.send_subscribed_tree(ws_user)
 
-				config[key] = self.config[key]
-			# add an empty entry for the password field
-			config['current_password'] = ''
-			ws_user.ws.emit(
-				"tree", {'user_data': self.users, 'config_data': config})
+	def send_subscribed_tree(self, ws_user, new_subscriber=True):
+		''' sends the whole user data as 'tree' message and the later changes as 'treedelta' messages
+
+		Args:
+		ws_user (:obj:`obj`): websocket client object
+		new_subscriber (:obj:`boolean`): False to send the tree only, if the user is still subscribed
+		'''
+
+		access_manager = self.modref.accessmanager
+		while True:
+			snapshot = access_manager.snapshot
+			message = self.tree_message(snapshot)  # encoded outside of the lock
+			# the tree is queued while holding the access manager lock, so the deltas of all later changes
+			# are queued after it, and the ones of the changes already in the tree are skipped by send_tree_deltas()
+			with access_manager.mutex:
+				if access_manager.snapshot is snapshot:
+					with self.tree_lock:
+						if not new_subscriber and not ws_user in self.tree_subscribers:
+							return  # closed meanwhile
+						self.tree_subscribers[ws_user] = snapshot.version
+					ws_user.ws.emit_json("tree", message)
+					return
+
+	def resend_tree(self):
+		''' sends the whole user data again to the subscribed websocket users,
+		e.g. after the user table has been calculated anew without any deltas
+		'''
+
+		with self.tree_lock:
+			subscribers = list(self.tree_subscribers)
+		for ws_user in subscribers:
+			self.send_subscribed_tree(ws_user, False)
+
+	def tree_message(self, snapshot):
+		''' returns the whole user data of a snapshot and the editable config as JSON encoded 'tree' data
+
+		The user data are encoded only once per snapshot version
+
+		Args:
+		snapshot (:obj:`UserSnapshot`): published user data of the access manager
+		'''
+
+		config = {}
+		for key in self.config_keys():
+			### if we have a password, then the token should not be changed through
+			# the UI because of the actual poor implementation of the password handling
+			if self.config['current_password'] and key=='messenger_token':
+				continue
+
+			config[key] = self.config[key]
+		# add an empty entry for the password field
+		config['current_password'] = ''
+		version, user_data = self.tree_cache
+		if version != snapshot.version:
+			user_data = json.dumps(self.users_as_json(
+				snapshot.users, snapshot.timetables))
+			self.tree_cache = (snapshot.version, user_data)
+		return '{{"version": {0}, "user_data": {1}, "config_data": {2}}}'.format(
+			snapshot.version, user_data, json.dumps(config))
+
+	def send_tree_deltas(self, deltas):
+		''' sends the changes of the user data to the subscribed websocket users
+
+		Args:
+		deltas (:obj:`list`): (snapshot version, JSON encoded 'treedelta' data)
+		'''
+
+		with self.tree_lock:
+			subscribers = list(self.tree_subscribers.items())
+		for ws_user, tree_version in subscribers:
+			for version, delta in deltas:
+				if version <= tree_version:  # already contained in the tree the user got
+					continue
+				try:
+					ws_user.ws.emit_json("treedelta", delta)
+				except Exception as ex:
+					logger.warning("couldn't send tree delta because {0}".format(ex))
+					break
 
 	def dummy(self, user):
 		''' empty procedure for websocket connect/disconnect handler
 		'''
 		pass
 
+	def ws_closed(self, ws_user):
+		''' removes a closed websocket from the tree subscribers
+		'''
+
+		with self.tree_lock:
+			self.tree_subscribers.pop(ws_user, None)
+
 	def read_config_value(self, key, default=None):
 		''' read value from config, identified by key
 
+		The config is completely held in memory, so this never reads from disk
+
 		Args:
 		key (:obj:`str`): lookup index
 		'''
@@ -196,46 +429,383 @@ Format of config.json:
 
 	def write_config_value(self, key, value, delay_write=False):
 		''' write value into config, identified by key.
-		Saves also straight to disk, if delay_write is not True
+		Saves also to disk, if delay_write is not True
 
 		Args:
 		key (:obj:`str`): lookup index
 		value (:obj:`obj`): value to store
-		delay_write (:obj:`boolean`): Do not save now
+		delay_write (:obj:`boolean`): Do not save now, but with the next save_config()
 		'''
 
-		self.config[key] = value
+		with self.config_lock:
+			self.config[key] = value
+			self.dirty_config_keys.add(key)
+			self.config_versions[key] = self.config_versions.get(key, 0) + 1
 		if not delay_write:
 			self.save_config()
 
+	def config_version(self, key):
+		''' returns a number which changes each time the config value is written,
+		so derived data can be cached until then
+
+		Args:
+		key (:obj:`str`): lookup index
+		'''
+
+		return self.config_versions.get(key, 0)
+
 	def save_config(self):
-		''' write config to disk
+		''' write the changed config values to disk
+
+		The write is done CONFIG_WRITE_DELAY seconds later, so all changes made
+		in the meantime are written together. Use flush_config() to write them now
 		'''
 
-		try:
-			with open(self.config_file_name, 'w') as outfile:
-				json.dump(self.config, outfile, sort_keys=True,
+		with self.config_lock:
+			if self.config_timer or not self.dirty_config_keys:
+				return
+			self.config_timer = threading.Timer(
+				defaults.CONFIG_WRITE_DELAY, self.flush_config)
+			self.config_timer.daemon = False  # let a pending write finish at program exit
+			self.config_timer.start()
+
+	def flush_config(self):
+		''' writes the changed config values to disk now
+		'''
+
+		with self.config_write_lock:
+			with self.config_lock:
+				if self.config_timer:
+					self.config_timer.cancel()
+					self.config_timer = None
+				dirty_keys = self.dirty_config_keys
+				self.dirty_config_keys = set()
+				if not dirty_keys:
+					return
+				try:
+					data = self.encode_config(dirty_keys)
+				except Exception as ex:
+					logger.warning("couldn't write config file {0} because {1}".format(
+						self.config_file_name, ex))
+					# try again with the next write
+					self.dirty_config_keys |= dirty_keys
+					return
+			try:
+				self.write_config_data(data)
+			except Exception as ex:
+				logger.warning("couldn't write config file {0} because {1}".format(
+					self.config_file_name, ex))
+				with self.config_lock:  # try again with the next write
+					self.dirty_config_keys |= dirty_keys
+
+	def encode_config(self, keys):
+		''' converts the config into the format written by write_config_data()
+
+		Args:
+		keys (:obj:`set`): the changed config keys
+		'''
+
+		return json.dumps(self.config, sort_keys=True,
 						  indent=4, separators=(',', ': '))
-		except:
-			logger.warning("couldn't write config file {0}".format(
-				self.config_file_name))
+
+	def write_config_data(self, text):
+		''' write config to disk
+		'''
+
+		self.write_file_safely(self.config_file_name, text)
 
 	def get_admin_ids(self):
 		''' get list of the admin IDs
 		'''
 		return self.read_config_value('admins')
 
-	def write_users(self):
-		''' Saves the users to disk
+	def write_users(self, wait=True, snapshot=None):
+		''' Saves the users to disk as a whole and clears the journal
+
+		Needs to be called while the user data is not changed (see AccessManager.mutex), unless
+		a snapshot is given, which is encoded later by the journal thread
+
+		Args:
+		wait (:obj:`boolean`): return only after the data are safe on disk
+		snapshot (:obj:`UserSnapshot`): published user data to save instead of the actual user data
 		'''
 
-		try:
-			with open(self.users_file_name, 'w') as outfile:
-				json.dump(self.users, outfile, sort_keys=True,
-						  indent=4, separators=(',', ': '))
-		except Exception as ex:
-			logger.warning("couldn't write users file {0} because {1}".format(
-				self.users_file_name, ex))
+		if snapshot is not None:
+			sequence = self.queue_journal_job('snapshot', snapshot)
+		else:
+			try:
+				data = self.encode_users()
+			except Exception as ex:
+				logger.warning("couldn't write users file {0} because {1}".format(
+					self.users_file_name, ex))
+				return
+			sequence = self.queue_journal_job('users', data)
+		if wait:
+			self.wait_for_users(sequence)
+
+	def journal_users(self, patch, snapshot=None):
+		''' appends a change of the user data to the journal
+
+		The record is just queued, use wait_for_users() to wait until it's safe on disk.
+		Once written, it is also sent as 'treedelta' to the subscribed websocket users.
+		Needs to be called while the user data is not changed (see AccessManager.mutex)
+
+		Args:
+		patch (:obj:`dict`): 'users' dict with the changed entries and 'edges' list of the changed
+				key lendings, see apply_users_patch()
+		snapshot (:obj:`UserSnapshot`): the published snapshot which contains the change
+
+		Return:
+		sequence number of the record for wait_for_users()
+		'''
+
+		delta = None
+		if snapshot is not None and self.tree_subscribers:
+			delta_data = self.users_as_json(
+				patch.get('users', {}), patch.get('timetables', {}))
+			delta_data['edges'] = patch.get('edges', [])
+			delta_data['version'] = snapshot.version
+			delta = (snapshot.version, json.dumps(delta_data))
+		sequence = self.queue_journal_job('record', self.encode_patch(patch), delta)
+		self.journal_records += 1
+		if self.compact_records and self.journal_records >= self.compact_records:
+			# the snapshot is encoded by the journal thread, so the caller doesn't wait for it
+			self.write_users(False, snapshot)
+		return sequence
+
+	def encode_users(self, snapshot=None):
+		''' converts the whole user data into the format written by write_journal_jobs()
+
+		Args:
+		snapshot (:obj:`UserSnapshot`): published user data to convert instead of the actual user data
+		'''
+
+		return json.dumps(self.snapshot_users(snapshot), sort_keys=True,
+						  indent=4, separators=(',', ': '), default=json_default)
+
+	def snapshot_users(self, snapshot=None):
+		''' returns the user data of a snapshot in the layout of the actual user data
+
+		Args:
+		snapshot (:obj:`UserSnapshot`): published user data, None for the actual user data
+		'''
+
+		if snapshot is None:
+			return self.users
+		users = {'users': snapshot.users, 'timetables': snapshot.timetables}
+		if snapshot.stamp is not None:
+			users['stamp'] = snapshot.stamp
+		return users
+
+	def encode_patch(self, patch):
+		''' converts a journal_users() patch into the format written by write_journal_jobs()
+		'''
+
+		return json.dumps(patch, separators=(',', ':'), default=json_default)
+
+	def queue_journal_job(self, job_type, data, delta=None):
+		''' queues data for the journal thread
+
+		Args:
+		job_type (:obj:`str`): 'record' for a journal record, 'users' for all user data,
+				'snapshot' for all user data still to be encoded by the journal thread
+		data (:obj:`obj`): the data to write, made by encode_patch() or encode_users(), or the snapshot
+		delta (:obj:`tuple`): optional (snapshot version, JSON encoded 'treedelta') to send after the write
+
+		Return:
+		sequence number of the job
+		'''
+
+		with self.journal_condition:
+			if not self.journal_thread:
+				self.journal_thread = threading.Thread(
+					target=self.journal_loop, daemon=True)
+				self.journal_thread.start()
+			self.journal_sequence += 1
+			if job_type in ('users', 'snapshot'):
+				self.journal_records = 0
+			self.journal_jobs.append((job_type, self.journal_sequence, data))
+			if delta:
+				self.tree_deltas.append(delta)
+			self.journal_condition.notify_all()
+			return self.journal_sequence
+
+	def wait_for_users(self, sequence):
+		''' waits until the journal job with the given sequence number is safe on disk
+		'''
+
+		with self.journal_condition:
+			while self.journal_written < sequence:
+				self.journal_condition.wait()
+
+	def journal_loop(self):
+		''' writes the queued journal jobs
+
+		all records which came in while the last write was running are written and synced
+		to disk together (group commit)
+		'''
+
+		while True:
+			with self.journal_condition:
+				while not self.journal_jobs:
+					self.journal_condition.wait()
+				jobs = self.journal_jobs
+				self.journal_jobs = []
+				deltas = self.tree_deltas
+				self.tree_deltas = []
+			last_sequence = jobs[-1][1]
+			jobs = self.encode_snapshot_jobs(jobs)
+			try:
+				self.write_journal_jobs(jobs)
+			except Exception as ex:
+				logger.warning("couldn't write users file {0} because {1}, trying again".format(
+					self.journal_file_name, ex))
+				# the waiting writers are only released after the jobs are safe on disk
+				with self.journal_condition:
+					self.journal_jobs[:0] = jobs
+					self.tree_deltas[:0] = deltas
+				time.sleep(defaults.JOURNAL_RETRY_DELAY)
+				continue
+			with self.journal_condition:
+				self.journal_written = last_sequence
+				self.journal_condition.notify_all()
+			if deltas:
+				self.send_tree_deltas(deltas)
+
+	def encode_snapshot_jobs(self, jobs):
+		''' encodes the snapshots of a group of journal jobs, so the access manager doesn't need to wait for it
+
+		A snapshot which can't be encoded is left out, its changes are still in the journal records
+
+		Args:
+		jobs (:obj:`list`): list of (job type, sequence number, data), see queue_journal_job()
+
+		Return:
+		the jobs with 'users' jobs instead of the 'snapshot' jobs
+		'''
+
+		encoded_jobs = []
+		for job_type, sequence, data in jobs:
+			if job_type == 'snapshot':
+				try:
+					data = self.encode_users(data)
+				except Exception as ex:
+					logger.warning("couldn't write users file {0} because {1}".format(
+						self.users_file_name, ex))
+					continue
+				job_type = 'users'
+			encoded_jobs.append((job_type, sequence, data))
+		return encoded_jobs
+
+	def write_journal_jobs(self, jobs):
+		''' writes a group of journal jobs to disk
+
+		Records followed by a new users.json don't need to be written at all
+
+		Args:
+		jobs (:obj:`list`): list of (job type, sequence number, data), see queue_journal_job()
+		'''
+
+		records = []
+		for job_type, sequence, text in jobs:
+			if job_type == 'users':
+				records = []  # already contained in the new users.json
+				self.write_file_safely(self.users_file_name, text)
+				self.close_journal_file()
+				self.journal_file = open(self.journal_file_name, 'w')
+				self.journal_length = 0
+				self.sync_file(self.journal_file)
+			else:
+				records.append(text)
+		if records:
+			try:
+				if not self.journal_file:
+					self.journal_file = open(self.journal_file_name, 'a')
+					if self.journal_length is None:
+						self.journal_length = self.journal_file.tell()
+				if self.journal_file.tell() > self.journal_length:
+					# cut off what a failed write has left, the records are written again now
+					self.journal_file.truncate(self.journal_length)
+				self.journal_file.write('\n'.join(records) + '\n')
+				self.sync_file(self.journal_file)
+			except Exception:
+				self.close_journal_file()
+				raise
+			self.journal_length = self.journal_file.tell()
+
+	def close_journal_file(self):
+		''' closes the journal, also if it's broken by a failed write
+		'''
+
+		if self.journal_file:
+			try:
+				self.journal_file.close()
+			except Exception:
+				pass  # the unwritten data are thrown away, they are written again by the retry
+			self.journal_file = None
+
+	def sync_file(self, open_file):
+		''' forces the data of an open file onto the disk
+		'''
+
+		open_file.flush()
+		os.fsync(open_file.fileno())
+
+	def write_file_safely(self, file_name, text):
+		''' replaces a file by writing a temporary file first and renaming it,
+		so there's always either the old or the new complete file on disk
+		'''
+
+		temp_file_name = file_name + '.tmp'
+		with open(temp_file_name, 'w') as outfile:
+			outfile.write(text)
+			self.sync_file(outfile)
+		os.replace(temp_file_name, file_name)
+		try:  # make the rename itself persistent
+			dir_fd = os.open(os.path.dirname(file_name), os.O_RDONLY)
+			try:
+				os.fsync(dir_fd)
+			finally:
+				os.close(dir_fd)
+		except OSError:
+			pass
+
+	def get_active_edges(self):
+		''' yields all key lendings without deletion date
+
+		Return:
+		iterator of (sponsor_id, time_table_id, follower_id)
+		'''
+
+		for sponsor_id, time_tables in self.users['timetables'].items():
+			for time_table_id, time_table in time_tables.items():
+				for follower_id, deletion_timestamp in time_table['users'].items():
+					if not deletion_timestamp:  # no deletion date set
+						yield sponsor_id, time_table_id, follower_id
+
+	def users_as_json(self, users, timetables):
+		''' returns a copy of the user data with the time tables in the JSON list format
+
+		Args:
+		users (:obj:`dict`): the 'users' part of the user data
+		timetables (:obj:`dict`): the 'timetables' part of the user data
+		'''
+
+		json_users = {}
+		for user_id, user_entry in users.items():
+			if user_entry is None:  # removed entry of a journal patch
+				json_users[user_id] = None
+				continue
+			time_table = user_entry['time_table']
+			json_users[user_id] = {'user': user_entry['user'],
+								   'time_table': time_table.to_list() if time_table is not None else None}
+		# the follower lists might be ChunkedDicts, which json can't handle by itself
+		json_timetables = {}
+		for sponsor_id, time_tables in timetables.items():
+			json_timetables[sponsor_id] = {time_table_id: {
+				'users': dict(time_table['users'].items()), 'deletion_timestamp': time_table['deletion_timestamp']}
+				for time_table_id, time_table in time_tables.items()}
+		return {'users': json_users, 'timetables': json_timetables}
 
 	def get_users(self):
 		''' returns the user data reference
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import functools
+from collections.abc import Mapping
+import defaults
+
+
+@functools.lru_cache(maxsize=None)
+def _field_masks(size):
+	''' returns the bit masks to handle all slots of a time table of the given size in one integer operation
+
+	each slot is stored in an 8 bit field, the highest bit of each field is used as guard bit
+	to do comparisons and subtractions in all fields at once without borrowing across the fields
+
+	Return:
+	low (:obj:`int`): 0x01 in each field
+	guard (:obj:`int`): 0x80 in each field
+	value (:obj:`int`): 0x7F in each field
+	'''
+
+	low = int.from_bytes(b'\x01' * size, 'big')
+	return low, low * 0x80, low * 0x7F
+
+
+class TimeTable:
+	''' compact, immutable time table
+
+	Each entry slot takes a single byte containing the TTL + 1, so 0 means "nothing allowed" (the former -1).
+	All overlay operations work on all slots at once by treating the bytes as one big integer,
+	so there is no python loop over the slots.
+
+	In JSON the time tables are still stored as list of integers, see to_list() and json_default()
+	'''
+
+	__slots__ = ('slots',)
+
+	MAX_TTL = 126  # the TTL + 1 needs to fit into 7 bits
+
+	def __init__(self, slots):
+		''' creates a time table out of the raw slot bytes
+
+		Args:
+		slots (:obj:`bytes`): one byte per slot, containing TTL + 1
+		'''
+
+		self.slots = bytes(slots)
+
+	@classmethod
+	def from_list(cls, values):
+		''' creates a time table out of the list format used in the JSON files
+
+		Args:
+		values (:obj:`list`): list of TTLs, -1 for nothing allowed
+		'''
+
+		try:
+			return cls(bytes(value + 1 for value in values))
+		except ValueError:
+			raise ValueError("time table values must be between -1 and {0}".format(cls.MAX_TTL))
+
+	@classmethod
+	def full(cls, ttl, size=defaults.TIME_TABLE_SIZE):
+		''' creates a fully packed time table, where each slot has the same ttl
+
+		Args:
+		ttl (:obj:`int`): the TTL for all slots
+		size (:obj:`int`): number of slots
+		'''
+
+		if not -1 <= ttl <= cls.MAX_TTL:
+			raise ValueError("time table values must be between -1 and {0}".format(cls.MAX_TTL))
+		return cls(bytes([ttl + 1]) * size)
+
+	@classmethod
+	def empty(cls, size=defaults.TIME_TABLE_SIZE):
+		''' creates a time table where nothing is allowed
+		'''
+
+		return cls(bytes(size))
+
+	def to_list(self):
+		''' returns the time table in the list format used in the JSON files
+		'''
+
+		return [value - 1 for value in self.slots]
+
+	def max_ttl(self):
+		''' returns the highest TTL of all slots
+		'''
+
+		return max(self.slots) - 1
+
+	def follow(self, ruleset=None):
+		''' calculates, what a follower gets out of this time table as sponsor table:
+		Each slot with a TTL > 0 is passed with a TTL reduced by 1, all other slots and the slots
+		not allowed by the ruleset are not passed
+
+		Args:
+		ruleset (:obj:`list`): optional list of booleans per slot, if the slot can be passed at all
+
+		Return:
+		new time table
+		'''
+
+		size = len(self.slots)
+		low, guard, value = _field_masks(size)
+		sponsor = int.from_bytes(self.slots, 'big')
+		# the guard bit stays set in all fields which had a value > 0 before the subtraction
+		reduced = (sponsor | guard) - low
+		passed = ((reduced & guard) >> 7) * 0xFF
+		result = reduced & value & passed
+		if ruleset is not None:
+			result &= int.from_bytes(bytes(0xFF if allowed else 0 for allowed in ruleset), 'big')
+		return TimeTable(result.to_bytes(size, 'big'))
+
+	def overlay(self, other):
+		''' merges two time tables by taking the higher TTL of each slot
+
+		Args:
+		other (:obj:`TimeTable`): time table to merge in
+
+		Return:
+		new time table
+		'''
+
+		size = len(self.slots)
+		low, guard, value = _field_masks(size)
+		own = int.from_bytes(self.slots, 'big')
+		foreign = int.from_bytes(other.slots, 'big')
+		# the guard bit stays set in all fields where own >= foreign
+		own_is_higher = ((((own | guard) - foreign) & guard) >> 7) * 0xFF
+		result = (own & own_is_higher) | (foreign & ~own_is_higher & (guard | value))
+		return TimeTable(result.to_bytes(size, 'big'))
+
+	def __len__(self):
+		return len(self.slots)
+
+	def __getitem__(self, index):
+		return self.slots[index] - 1
+
+	def __iter__(self):
+		return (value - 1 for value in self.slots)
+
+	def __eq__(self, other):
+		if not isinstance(other, TimeTable):
+			return NotImplemented
+		return self.slots == other.slots
+
+	def __hash__(self):
+		return hash(self.slots)
+
+	def __repr__(self):
+		return 'TimeTable({0})'.format(self.to_list())
+
+
+def json_default(obj):
+	''' hook for json.dump() to write time tables in the list format
+
+	Args:
+	obj (:obj:`obj`): the object json can't handle by itself
+	'''
+
+	if isinstance(obj, TimeTable):
+		return obj.to_list()
+	if isinstance(obj, Mapping):  # e.g. the ChunkedDict follower lists
+		return dict(obj.items())
+	raise TypeError("Object of type {0} is not JSON serializable".format(
+		type(obj).__name__))
+
+
+if __name__ == '__main__':
+	# compares the former list based time table overlay with the TimeTable class
+	import random
+	import sys
+	import time
+
+	size = defaults.ENTRY_SLOTS_PER_HOUR * 24 * defaults.FORECAST_DAYS
+	user_count = 10000
+	ttl = defaults.TIME_TO_LIVE
+
+	def list_follower_time_table(sponsor_table, follower_table):
+		''' the former implementation out of AccessManager.calculate_follower_time_table() '''
+		if not follower_table:
+			follower_table = []
+			for i in range(size):
+				follower_table.append(-1)
+		ruleset_table = []
+		for i in range(size):
+			ruleset_table.append(True)
+		for i in range(size):
+			if ruleset_table[i]:
+				sponsor_ttl = sponsor_table[i]
+				if sponsor_ttl > 0:
+					new_ttl = sponsor_ttl-1
+					if follower_table[i] < new_ttl:
+						follower_table[i] = new_ttl
+		return follower_table
+
+	random.seed(42)
+	sponsor_lists = [[random.randint(-1, ttl) for i in range(size)] for j in range(user_count)]
+	follower_lists = [[random.randint(-1, ttl) for i in range(size)] for j in range(user_count)]
+	sponsor_tables = [TimeTable.from_list(values) for values in sponsor_lists]
+	follower_tables = [TimeTable.from_list(values) for values in follower_lists]
+
+	start = time.perf_counter()
+	list_results = [list_follower_time_table(sponsor, list(follower))
+					for sponsor, follower in zip(sponsor_lists, follower_lists)]
+	list_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	table_results = [follower.overlay(sponsor.follow())
+					 for sponsor, follower in zip(sponsor_tables, follower_tables)]
+	table_time = time.perf_counter() - start
+
+	if [table.to_list() for table in table_results] != list_results:
+		print('results differ!')
+		sys.exit(1)
+	# small integers are shared by python, so a list costs mainly its pointers
+	list_size = sys.getsizeof(sponsor_lists[0])
+	table_size = sys.getsizeof(sponsor_tables[0]) + sys.getsizeof(sponsor_tables[0].slots)
+	print('{0} slots x {1} users'.format(size, user_count))
+	print('{0:12} {1:>12} {2:>16}'.format('', 'overlay (ms)', 'bytes per table'))
+	print('{0:12} {1:>12.1f} {2:>16}'.format('list', list_time * 1000, list_size))
+	print('{0:12} {1:>12.1f} {2:>16}'.format('TimeTable', table_time * 1000, table_size))
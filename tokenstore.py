@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import heapq
+import time
+from threading import Lock
+import defaults
+import zuullogger
+
+logger = zuullogger.getLogger(__name__)
+
+
+class TokenStore:
+	''' keeps the actual valid one time passwords
+
+	The tokens are stored in a dict for the lookup and additionally in a heap ordered by their
+	expiry time, so expired tokens are removed from the top of the heap without going through all tokens.
+	The number of tokens is limited, and a token is only accepted if it's not already in use
+	'''
+
+	def __init__(self, max_tokens=defaults.MAX_OTP_TOKENS):
+		'''
+		Args:
+		max_tokens (:obj:`int`): maximal number of tokens valid at the same time
+		'''
+
+		self.max_tokens = max_tokens
+		self.mutex = Lock()
+		self.tokens = {}  # token -> unix timestamp, until when the token is valid
+		self.expiries = []  # heap of (unix timestamp, token)
+
+	def expire(self, now):
+		''' removes all tokens which are expired at unix timestamp now
+		'''
+
+		while self.expiries and self.expiries[0][0] < now:
+			valid_until, token = heapq.heappop(self.expiries)
+			# the token might have been added again later with another expiry
+			if self.tokens.get(token) == valid_until:
+				del self.tokens[token]
+
+	def is_full(self, now=None):
+		''' returns True, if no further token can be added just now
+		'''
+
+		if now is None:
+			now = time.time()
+		with self.mutex:
+			self.expire(now)
+			return len(self.tokens) >= self.max_tokens
+
+	def add(self, token, valid_until, now=None):
+		''' stores a new token
+
+		Args:
+		token (:str:`str`): the token string
+		valid_until (:obj:`float`): unix timestamp, until when the token shall be valid
+		now (:obj:`float`): actual unix timestamp, just for testing
+
+		Return:
+		False, if the token is already in use by someone else or the store is full
+		'''
+
+		if now is None:
+			now = time.time()
+		with self.mutex:
+			self.expire(now)
+			if token in self.tokens:
+				return False
+			if len(self.tokens) >= self.max_tokens:
+				logger.warning("too many valid tokens ({0}), token refused".format(
+					len(self.tokens)))
+				return False
+			self.tokens[token] = valid_until
+			heapq.heappush(self.expiries, (valid_until, token))
+			return True
+
+	def is_valid(self, token, now=None):
+		''' checks if the token is known and not expired
+
+		Args:
+		token (:str:`str`): the token string
+		now (:obj:`float`): actual unix timestamp, just for testing
+		'''
+
+		if now is None:
+			now = time.time()
+		with self.mutex:
+			self.expire(now)
+			return token in self.tokens
+
+	def __len__(self):
+		return len(self.tokens)
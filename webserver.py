@@ -25,6 +25,9 @@ import threading
 
 from pprint import pprint
 
+import defaults
+import wsframe
+
 from socketserver import ThreadingMixIn
 from http.server import HTTPServer
 from io import StringIO
@@ -37,13 +40,40 @@ class WebsocketUser:
 	def __init__(self, name, ws):
 		self.name = name
 		self.ws = ws
+		# message types of the broadcasts the client wants, None for all, see ws_subscribe
+		self.subscriptions = None
 
 
 modules = {}
-ws_clients = []
+# the connected clients as tuple, which is replaced on each change instead of changed,
+# so it can be iterated without lock while connections come and go
+ws_clients = ()
+ws_clients_lock = threading.Lock()
+
+
+def add_ws_client(user):
+	''' adds a connected websocket client to ws_clients
+	'''
 
+	global ws_clients
+	with ws_clients_lock:
+		ws_clients = ws_clients + (user,)
+
+
+def remove_ws_client(user):
+	''' removes a closed websocket client from ws_clients
+	'''
 
-class WSZuulHandler(HTTPWebSocketsHandler):
+	global ws_clients
+	with ws_clients_lock:
+		ws_clients = tuple(client for client in ws_clients if client is not user)
+
+
+class WSZuulDispatcher:
+	''' connects a websocket connection with the registered modules
+
+	Used by both server backends, the connection class needs to provide send_message() and log_message()
+	'''
 
 	def get_module(self, prefix):
 		'''returns registered module by name
@@ -66,6 +96,17 @@ class WSZuulHandler(HTTPWebSocketsHandler):
 		message = {'type': type, 'config': config}
 		self.send_message(json.dumps(message))
 
+	def emit_json(self, type, config_json):
+		''' sends an already JSON encoded data object to websocket client
+
+		Args:
+		type (:obj:`str`): string identifier of the contained data type
+		config_json (:obj:`str`): JSON string of the data object to be sent
+		'''
+
+		self.send_message('{{"type": {0}, "config": {1}}}'.format(
+			json.dumps(type), config_json))
+
 	def on_ws_message(self, message):
 		''' distributes incoming messages to the registered modules
 
@@ -90,6 +131,16 @@ class WSZuulHandler(HTTPWebSocketsHandler):
 		if data['type'] == 'msg':
 			self.log_message('msg %s', data['data'])
 
+		elif data['type'] == 'ws_subscribe':
+			# config: list of message types to receive as broadcast, or null for all of them again
+			types = data.get('config')
+			if types is None:
+				self.user.subscriptions = None
+			elif isinstance(types, list) and all(isinstance(name, str) for name in types):
+				self.user.subscriptions = frozenset(types)
+			else:
+				self.log_message('%s', 'Invalid ws_subscribe')
+
 		else:
 			unknown_msg = True
 			global modules
@@ -105,8 +156,7 @@ class WSZuulHandler(HTTPWebSocketsHandler):
 		'''
 		#self.log_message('%s', 'websocket connected')
 		self.user = WebsocketUser("", self)
-		global ws_clients
-		ws_clients.append(self.user)
+		add_ws_client(self.user)
 		global modules
 		for module in modules.values():
 			module["onWebSocketOpen"](self.user)
@@ -116,12 +166,14 @@ class WSZuulHandler(HTTPWebSocketsHandler):
 		'''
 
 		#self.log_message('%s', 'websocket closed')
-		global ws_clients
-		ws_clients.remove(self.user)
+		remove_ws_client(self.user)
 		global modules
 		for module_name, module in modules.items():
 			module["onWebSocketClose"](self.user)
 
+
+class WSZuulHandler(WSZuulDispatcher, HTTPWebSocketsHandler):
+
 	def setup(self):
 		'''initialise the websocket
 		'''
@@ -129,8 +181,8 @@ class WSZuulHandler(HTTPWebSocketsHandler):
 		super(HTTPWebSocketsHandler, self).setup()
 
 
-class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
-	'''Threaded HTTP and Websocket server'''
+class ModuleRegistry:
+	''' the module interface of both server backends '''
 
 	def register(self, prefix, module, wsMsghandler, wsOnOpen, wsOnClose):
 		''' register other modules as Websocket message consumers
@@ -158,11 +210,23 @@ class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
 			return None
 
 	def emit(self, topic, data):
-		'''broadcasts a message to all connected websocket clients
+		'''broadcasts a message to all connected websocket clients, which have subscribed its type
+		or have not subscribed anything at all
+
+		The frame is encoded only once and queued at each client without waiting for any of them
 		'''
-		global ws_clients
-		for user in ws_clients:
-			user.ws.emit(topic, data)
+		receivers = [user for user in ws_clients
+					 if user.subscriptions is None or topic in user.subscriptions]
+		if not receivers:
+			return
+		frame = wsframe.encode_frame(wsframe.OPCODE_TEXT, json.dumps(
+			{'type': topic, 'config': data}))
+		for user in receivers:
+			user.ws.send_frame(frame)
+
+
+class ThreadedHTTPServer(ModuleRegistry, ThreadingMixIn, HTTPServer):
+	'''Threaded HTTP and Websocket server'''
 
 
 def ws_create(modref):
@@ -181,6 +245,23 @@ def ws_create(modref):
 	parser.add_argument("-c", "--credentials",  default=server_config["credentials"],
 						help="user credentials")
 	args = parser.parse_args()
+	max_message_size = server_config.get(
+		"max_message_size", defaults.WS_MAX_MESSAGE_SIZE)
+	send_queue_size = server_config.get(
+		"send_queue_size", defaults.WS_SEND_QUEUE_SIZE)
+	if server_config.get("backend", defaults.WS_SERVER_BACKEND) == 'asyncio':
+		import asyncwebserver  # imports this module itself, so not at the top
+		ssl_context = None
+		if args.secure:
+			ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+			ssl_context.load_cert_chain(certfile='./server.pem', keyfile='./key.pem')
+		server = asyncwebserver.AsyncHTTPServer(
+			(args.host, args.port), os.path.join(os.path.dirname(__file__), 'public'),
+			args.credentials, ssl_context, max_message_size, send_queue_size)
+		print('initialized asyncio %s server at port %d' % ('https' if args.secure else 'http', args.port))
+		return server
+	WSZuulHandler.max_message_size = max_message_size
+	WSZuulHandler.send_queue_size = send_queue_size
 	server = ThreadedHTTPServer((args.host, args.port), WSZuulHandler)
 	server.daemon_threads = True
 	server.auth = b64encode(args.credentials.encode("ascii"))
@@ -207,7 +288,7 @@ def _ws_main(server):
 		os.chdir(origin_dir)
 	except KeyboardInterrupt:
 		print('^C received, shutting down server')
-		server.socket.close()
+		server.server_close()
 
 
 def ws_thread(server):
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+websocket frame codec used by HTTPWebSocketsHandler
+
+Unmasks whole payloads at once by XORing them as one big integer instead of byte by byte,
+reassembles fragmented messages and refuses messages bigger than a configurable limit,
+before any payload is read. Outgoing frames are built as one buffer, so they can be sent with a single call.
+'''
+
+import struct
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xa
+MAX_CONTROL_PAYLOAD = 125
+DEFAULT_MAX_MESSAGE_SIZE = 16 * 1024 * 1024
+
+_extended_length = {126: struct.Struct('>H'), 127: struct.Struct('>Q')}
+_short_header = struct.Struct('>BB')
+_medium_header = struct.Struct('>BBH')
+_long_header = struct.Struct('>BBQ')
+
+
+class WebSocketError(Exception):
+    pass
+
+
+def unmask(mask, data):
+    ''' XORs the payload with the repeated 4 byte mask
+
+    Args:
+    mask (:obj:`bytes`): the 4 mask bytes of the frame
+    data (:obj:`bytes`): the masked payload
+
+    Return:
+    the unmasked payload as bytes
+    '''
+
+    length = len(data)
+    if not length:
+        return b''
+    key = (mask * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, 'little') ^ int.from_bytes(key, 'little')).to_bytes(length, 'little')
+
+
+def encode_frame(opcode, payload):
+    ''' builds an unmasked, unfragmented frame as the server sends it
+
+    Args:
+    opcode (:obj:`int`): the frame opcode
+    payload (:obj:`obj`): str (sent as UTF-8) or bytes
+
+    Return:
+    the whole frame as bytes
+    '''
+
+    if isinstance(payload, str):
+        payload = payload.encode()
+    length = len(payload)
+    if length <= 125:
+        header = _short_header.pack(0x80 | opcode, length)
+    elif length <= 0xFFFF:
+        header = _medium_header.pack(0x80 | opcode, 126, length)
+    else:
+        header = _long_header.pack(0x80 | opcode, 127, length)
+    return header + payload
+
+
+class FrameReader:
+    ''' reads websocket messages out of a file like object
+
+    Control frames (close, ping, pong) are returned as soon as they arrive, also in the middle of a
+    fragmented message. Data frames are collected until the final frame of the message.
+
+    The frame parsing in parse_message() does no I/O itself, it only asks for the number of bytes it needs next,
+    so it is shared by the blocking read_message() and asynchronous readers.
+    '''
+
+    def __init__(self, rfile, max_message_size=DEFAULT_MAX_MESSAGE_SIZE):
+        '''
+        Args:
+        rfile (:obj:`obj`): the buffered input stream of the connection
+        max_message_size (:obj:`int`): maximal payload size of a whole message
+        '''
+
+        self.rfile = rfile
+        self.max_message_size = max_message_size
+        self.fragments = []
+        self.fragments_size = 0
+        self.fragments_opcode = None
+
+    def _read_exactly(self, length):
+        data = self.rfile.read(length)
+        if len(data) != length:
+            raise EOFError()
+        return data
+
+    def parse_frame(self):
+        ''' generator which parses a single frame
+
+        Yields the number of bytes needed next and expects them to be sent in.
+
+        Return:
+        tuple of fin flag, opcode and unmasked payload
+        '''
+
+        first, second = yield 2
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if not second & 0x80:
+            raise WebSocketError("unmasked frame from client")
+        # the extended length and the mask come in one read
+        length_format = _extended_length.get(length)
+        if length_format:
+            header = yield length_format.size + 4
+            length = length_format.unpack_from(header)[0]
+            mask = header[length_format.size:]
+        else:
+            mask = yield 4
+        if opcode & 0x8:
+            if length > MAX_CONTROL_PAYLOAD or not fin:
+                raise WebSocketError("invalid control frame")
+        elif self.fragments_size + length > self.max_message_size:
+            raise WebSocketError("message exceeds {0} bytes".format(self.max_message_size))
+        payload = yield length
+        return fin, opcode, unmask(mask, payload)
+
+    def parse_message(self):
+        ''' generator which parses frames until a complete message or a control frame is received
+
+        Yields the number of bytes needed next and expects them to be sent in.
+
+        Return:
+        tuple of opcode and payload
+        '''
+
+        while True:
+            fin, opcode, payload = yield from self.parse_frame()
+            if opcode & 0x8:
+                return opcode, payload
+            if opcode == OPCODE_CONTINUATION:
+                if self.fragments_opcode is None:
+                    raise WebSocketError("continuation frame without message start")
+            elif self.fragments_opcode is not None:
+                raise WebSocketError("new message before the last one was complete")
+            else:
+                self.fragments_opcode = opcode
+            if fin and not self.fragments:  # the usual unfragmented message
+                self.fragments_opcode = None
+                return opcode, payload
+            self.fragments.append(payload)
+            self.fragments_size += len(payload)
+            if fin:
+                message = (self.fragments_opcode, b''.join(self.fragments))
+                self.fragments = []
+                self.fragments_size = 0
+                self.fragments_opcode = None
+                return message
+
+    def read_message(self):
+        ''' reads the next message, see parse_message()
+
+        Return:
+        tuple of opcode and payload, None if the connection has been closed
+        '''
+
+        parser = self.parse_message()
+        try:
+            length = next(parser)
+            while True:
+                length = parser.send(self._read_exactly(length))
+        except StopIteration as result:
+            return result.value
+        except EOFError:
+            return None
+
+
+if __name__ == '__main__':
+    # compares the former byte by byte unmasking with the codec
+    import io
+    import os
+    import time
+
+    def loop_unmask(masks, datastream):
+        ''' the former implementation out of HTTPWebSocketsHandler._read_next_message() '''
+        decoded = bytearray()
+        for char in datastream:
+            decoded.append(char ^ masks[len(decoded) % 4])
+        return bytes(decoded)
+
+    def client_frames(payload, opcode=0x1, fragment_size=None):
+        ''' builds masked frames like a browser '''
+        fragment_size = fragment_size or len(payload) or 1
+        chunks = [payload[pos:pos + fragment_size]
+                  for pos in range(0, len(payload), fragment_size)] or [b'']
+        frames = bytearray()
+        for index, chunk in enumerate(chunks):
+            first = (0x80 if index == len(chunks) - 1 else 0) | (opcode if index == 0 else 0)
+            frames.append(first)
+            if len(chunk) <= 125:
+                frames.append(0x80 | len(chunk))
+            elif len(chunk) <= 0xFFFF:
+                frames += bytes([0x80 | 126]) + struct.pack('>H', len(chunk))
+            else:
+                frames += bytes([0x80 | 127]) + struct.pack('>Q', len(chunk))
+            mask = os.urandom(4)
+            frames += mask + unmask(mask, chunk)
+        return bytes(frames)
+
+    payload = os.urandom(100000)
+    reader = FrameReader(io.BytesIO(client_frames(payload, 0x2, 3000) + client_frames(b'', 0x9)))
+    print(reader.read_message() == (0x2, payload), reader.read_message() == (0x9, b''),
+          reader.read_message() is None)
+    reader = FrameReader(io.BytesIO(client_frames(payload)), max_message_size=50000)
+    try:
+        reader.read_message()
+        print(False)
+    except WebSocketError:
+        print(True)
+
+    print('{0:>10} {1:>14} {2:>14} {3:>14}'.format(
+        'bytes', 'loop (MB/s)', 'unmask (MB/s)', 'reader (MB/s)'))
+    for size in (125, 4096, 65536, 1024 * 1024):
+        data = os.urandom(size)
+        mask = os.urandom(4)
+        rounds = max(1, 4 * 1024 * 1024 // size)
+        start = time.perf_counter()
+        for i in range(max(1, rounds // 16)):
+            expected = loop_unmask(mask, data)
+        loop_rate = max(1, rounds // 16) * size / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for i in range(rounds):
+            result = unmask(mask, data)
+        unmask_rate = rounds * size / (time.perf_counter() - start)
+        if result != expected:
+            print('results differ!')
+        stream = io.BytesIO(client_frames(data) * rounds)
+        reader = FrameReader(stream)
+        start = time.perf_counter()
+        for i in range(rounds):
+            reader.read_message()
+        reader_rate = rounds * size / (time.perf_counter() - start)
+        print('{0:>10} {1:>14.1f} {2:>14.1f} {3:>14.1f}'.format(
+            size, loop_rate / 1e6, unmask_rate / 1e6, reader_rate / 1e6))
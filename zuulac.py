@@ -42,17 +42,22 @@ def restart():
 	logger.info('restarted')
 
 
+startup_start = time.perf_counter()
 modref = ModRef() # create object to store all module instances
-modref.store = storage.Storage(modref)
+modref.store = storage.create_storage(modref)
 modref.server = webserver.ws_create(modref)
 
 modref.accessmanager = accessmanager.AccessManager(
 	modref, restart)
+# report, where the startup time went
+startup_times = modref.store.startup_times + modref.accessmanager.startup_times
+logger.info('startup took {0:.1f} ms: {1}'.format((time.perf_counter() - startup_start) * 1000,
+	', '.join('{0} {1:.1f} ms'.format(step, secs * 1000) for step, secs in startup_times)))
 # announce all receiving modules to the websocket handler
 modref.server.register("ac_", None, modref.accessmanager.msg,
 					   modref.accessmanager.dummy, modref.accessmanager.dummy)
 modref.server.register("st_", None, modref.store.msg,
-					   modref.store.dummy, modref.store.dummy)
+					   modref.store.dummy, modref.store.ws_closed)
 
 
 restart()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+lends and returns many keys in one go by sending a CSV or NDJSON file as ac_bulk message to a running zuul-ac
+
+CSV files need a header line, both formats use the fields
+action ('grant' or 'revoke'), sponsor_id, user_id, first_name, last_name, language
+
+example:
+	action,sponsor_id,user_id,first_name,last_name,language
+	grant,1137173018,86360813,Madlen,,de
+	revoke,1137173018,12345678,,,
+'''
+
+import argparse
+import json
+
+import websocket
+
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="lend and return many zuul-ac keys in one go")
+	parser.add_argument("file", help="CSV or NDJSON file containing the changes")
+	parser.add_argument("--url", default="ws://localhost:8000/",
+						help="websocket url of zuul-ac")
+	parser.add_argument("--password", default="",
+						help="the current_password of the zuul-ac config")
+	parser.add_argument("--format", choices=['csv', 'ndjson'],
+						help="file format, default by file extension")
+	args = parser.parse_args()
+	data_format = args.format
+	if not data_format:
+		data_format = 'ndjson' if args.file.lower().endswith(('.ndjson', '.jsonl')) else 'csv'
+	with open(args.file, encoding='utf-8') as change_file:
+		text = change_file.read()
+
+	ws = websocket.create_connection(args.url)
+	try:
+		ws.send(json.dumps({'type': 'ws_subscribe', 'config': []}))  # no broadcasts needed
+		ws.send(json.dumps({'type': 'ac_bulk', 'config': {
+			'current_password': args.password, 'format': data_format, 'data': text}}))
+		while True:  # ignore other messages like otprequest broadcasts
+			data = json.loads(ws.recv())
+			if data.get('type') == 'bulkresult':
+				break
+	finally:
+		ws.close()
+	result = data['config']
+	for error in result['errors']:
+		print(error)
+	print("{0} changes applied, {1} users got or lost access".format(
+		result['changes'], len(result['changed_users'])))
+
+
+if __name__ == '__main__':
+	main()
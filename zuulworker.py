@@ -35,6 +35,10 @@ class ZuulWorker:
         msg_type=data.get("type","")
         if msg_type=="otprequest" and self.otp_request is not None:
             response=self.otp_request(data)
+            # send the request id back, so zuul can match the answer to its request
+            request_id=data.get('config',{}).get('request_id')
+            if request_id is not None:
+                response['config'].setdefault('request_id',request_id)
             #print("sending otp approval...")
             ws.send(json.dumps(response))
         elif msg_type=="tokenstate" and self.open_door is not None:
@@ -56,6 +60,9 @@ class ZuulWorker:
         print("### closed ###")
 
     def on_open(self,ws):
+        # only the otp requests are needed out of the broadcasts
+        ws.send(json.dumps({"type": "ws_subscribe",
+                            "config": ["otprequest"] if self.otp_request is not None else []}))
         if self.get_input is not None:
             print("Opened connection")
             def run(*args):